@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""Benchmark the observation path, from emulator frame to minibatch.
+
+Runs every stage on synthetic SNES sized RGB frames, so neither ROMs
+nor the emulator are needed, and reports for each stage:
+
+- ops_per_sec: calls per second (frames/sec for per-frame stages,
+  batches/sec for sampling stages), best of --repeat runs.
+- alloc_bytes_per_op: mean bytes allocated above the baseline by one
+  call, i.e. the temporaries it creates (tracemalloc peak).
+- peak_bytes: largest of those over the stage.
+- retained_bytes: memory still allocated after the stage.
+
+Timings are measured without tracemalloc, which slows allocations.
+
+Results can be written as JSON with --output and compared with the
+JSON of another commit with --baseline: stages that got slower by more
+than --max_slowdown make the script exit with status 1.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from deeprl_hw2.core import ReplayMemory
+from deeprl_hw2.preprocessors import AtariPreprocessor, HistoryPreprocessor, MovementDetector
+
+
+def make_frames(num_frames, frame_shape, seed=0):
+    """Random frames made of moving smooth shapes plus noise."""
+    rng = np.random.RandomState(seed)
+    rows, cols = np.mgrid[:frame_shape[0], :frame_shape[1]]
+    frames = np.empty((num_frames,) + frame_shape, dtype = np.uint8)
+    base = np.sin(rows / 17.0 + cols / 23.0)
+    for i in range(num_frames):
+        shifted = np.roll(base, i, axis=1)
+        frame = shifted[:, :, np.newaxis] * [90, 60, 120] + 128 + rng.normal(0, 4, frame_shape)
+        frames[i] = np.clip(frame, 0, 255)
+    return frames
+
+
+def measure(name, function, num_ops, repeat):
+    """Time function(i) for i in range(num_ops) and trace its memory."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for i in range(num_ops):
+            function(i)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    alloc_bytes = 0
+    peak_bytes = 0
+    retained_bytes = 0
+    for i in range(num_ops):
+        if hasattr(tracemalloc, 'reset_peak'):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        else:
+            # Python < 3.9, restarting clears the peak but also forgets
+            # the memory retained so far, so keep track of it
+            retained_bytes += tracemalloc.get_traced_memory()[0] - baseline
+            tracemalloc.stop()
+            tracemalloc.start()
+            before = baseline = tracemalloc.get_traced_memory()[0]
+        function(i)
+        op_bytes = tracemalloc.get_traced_memory()[1] - before
+        alloc_bytes += op_bytes
+        peak_bytes = max(peak_bytes, op_bytes)
+    retained_bytes += tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+
+    result = {
+        'ops_per_sec': num_ops / best,
+        'alloc_bytes_per_op': alloc_bytes / float(num_ops),
+        'peak_bytes': peak_bytes,
+        'retained_bytes': retained_bytes,
+    }
+    print("%-40s %10.1f ops/s %12.0f B/op %12d B peak %12d B retained"
+        % (name, result['ops_per_sec'], result['alloc_bytes_per_op'], peak_bytes, retained_bytes))
+    return result
+
+
+def make_memory(args):
+    memory_args = argparse.Namespace(
+        replay_memory_size = args.replay_memory_size,
+        num_frames = args.num_frames,
+        frame_height = args.frame_height,
+        frame_width = args.frame_width,
+        memory_dir = '',
+        compress_memory = False,
+        memory_cache_size = 0)
+    return ReplayMemory(memory_args)
+
+
+def run(args):
+    new_size = (args.frame_height, args.frame_width)
+    frames = make_frames(args.num_frames_per_run, (args.screen_height, args.screen_width, 3))
+    num_ops = len(frames)
+    atari_processor = AtariPreprocessor(new_size)
+    memory_frames = atari_processor.process_batch_for_memory(frames)
+    network_frames = memory_frames.astype(np.float32) / 255.0
+    results = {}
+
+    def stage(name, function, num_ops=num_ops):
+        results[name] = measure(name, function, num_ops, args.repeat)
+
+    stage('atari.process_state_for_memory', lambda i: atari_processor.process_state_for_memory(frames[i]))
+    stage('atari.process_state_for_network', lambda i: atari_processor.process_state_for_network(frames[i]))
+    # each frame is asked for twice, like fit does
+    stage('atari.process_frame', lambda i: (atari_processor.process_frame(frames[i], i),
+        atari_processor.process_frame(frames[i], i)))
+    out = np.empty_like(memory_frames)
+    stage('atari.process_batch_for_memory', lambda i: atari_processor.process_batch_for_memory(frames, out), 1)
+
+    history_processor = HistoryPreprocessor(args.num_frames - 1, dtype = np.float32)
+    stage('history.process_state_for_network', lambda i: history_processor.process_state_for_network(network_frames[i]))
+    movement_detector = MovementDetector(args.num_frames_mv)
+    stage('movement.append+min_diff', lambda i: (movement_detector.append(network_frames[i]),
+        movement_detector.min_diff(network_frames[(i + 1) % num_ops])))
+
+    memory = make_memory(args)
+    stage('memory.append', lambda i: memory.append(memory_frames[i], i % 4, 1.0, i % 100 == 99))
+    # fill the memory so sampling sees realistic sizes
+    for i in range(args.replay_memory_size):
+        memory.append(memory_frames[i % num_ops], i % 4, 1.0, i % 1000 == 999)
+    num_batches = max(num_ops // args.batch_size, 1)
+    stage('memory.sample', lambda i: memory.sample(args.batch_size), num_batches)
+    stage('memory.sample_batch', lambda i: memory.sample_batch(args.batch_size), num_batches)
+
+    # process_batch converts the samples in place, give it new ones every call
+    samples = [memory.sample(args.batch_size) for _ in range(num_batches)]
+    stage('atari.process_batch', lambda i: atari_processor.process_batch(samples[i]), num_batches)
+    batch = memory.sample_batch(args.batch_size)
+    stage('atari.process_batch_arrays', lambda i: atari_processor.process_batch_arrays(batch.states,
+        batch.next_states), num_batches)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, max_slowdown):
+    """Print the speed of each stage relative to a baseline run.
+
+    Returns
+    -------
+    list(str)
+      Stages slower than the baseline by more than max_slowdown.
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print("\ncompared with %s (commit %s)" % (baseline_path, baseline.get('commit')))
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline['stages']:
+            continue
+        ratio = result['ops_per_sec'] / baseline['stages'][name]['ops_per_sec']
+        flag = ''
+        if ratio < 1.0 - max_slowdown:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print("%-40s %6.2fx%s" % (name, ratio, flag))
+    return regressions
+
+
+def main():  # noqa: D103
+    parser = argparse.ArgumentParser(description='Benchmark the observation pipeline')
+    parser.add_argument('--num_frames_per_run', default=512, type=int, help='Number of frames each stage processes per run')
+    parser.add_argument('--repeat', default=3, type=int, help='Runs per stage, the fastest one is kept')
+    parser.add_argument('--screen_height', default=224, type=int, help='Emulator screen height')
+    parser.add_argument('--screen_width', default=256, type=int, help='Emulator screen width')
+    parser.add_argument('--frame_height', default=84, type=int, help='Resized frame height')
+    parser.add_argument('--frame_width', default=84, type=int, help='Resized frame width')
+    parser.add_argument('--num_frames', default=4, type=int, help='Number of frames to feed to Q-Network')
+    parser.add_argument('--num_frames_mv', default=10, type=int, help='Number of frames to used to detect movement')
+    parser.add_argument('--replay_memory_size', default=100000, type=int, help='Replay memory size')
+    parser.add_argument('--batch_size', default=32, type=int, help='Minibatch size')
+    parser.add_argument('--output', default='', help='Write the results as JSON to this file')
+    parser.add_argument('--baseline', default='', help='JSON results of a previous run to compare with')
+    parser.add_argument('--max_slowdown', default=0.1, type=float, help='Slowdown relative to the baseline reported as a regression')
+    args = parser.parse_args()
+
+    results = run(args)
+    report = {
+        'commit': git_commit(),
+        'time': time.time(),
+        'numpy': np.__version__,
+        'args': vars(args),
+        'stages': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.max_slowdown)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""Benchmark AtariPreprocessor against the PIL reference implementation.
+
+Checks that the NumPy kernel stays within --tolerance grey levels of
+PIL's convert('L').resize(..., Image.BILINEAR) and reports the time
+per frame of both, single frames and batches.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from deeprl_hw2.preprocessors import AtariPreprocessor
+
+
+def pil_process_state_for_memory(state, new_size):
+    """The PIL conversion AtariPreprocessor used to do."""
+    img = Image.fromarray(state).convert('L').resize((new_size[1], new_size[0]), Image.BILINEAR)
+    return np.array(img)
+
+
+def make_frames(num_frames, frame_shape, seed=0):
+    """Random frames made of smooth shapes plus noise, like game screens."""
+    rng = np.random.RandomState(seed)
+    rows, cols = np.mgrid[:frame_shape[0], :frame_shape[1]]
+    frames = np.empty((num_frames,) + frame_shape, dtype = np.uint8)
+    for i in range(num_frames):
+        base = np.sin(rows / rng.uniform(5, 40) + cols / rng.uniform(5, 40))
+        frame = (base[:, :, np.newaxis] * rng.uniform(-127, 127, 3) + 128
+            + rng.normal(0, 8, frame_shape))
+        frames[i] = np.clip(frame, 0, 255)
+    return frames
+
+
+def time_per_frame(function, num_frames, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best / num_frames
+
+
+def main():  # noqa: D103
+    parser = argparse.ArgumentParser(description='Benchmark frame preprocessing')
+    parser.add_argument('--num_frames', default=256, type=int, help='Number of frames per run')
+    parser.add_argument('--repeat', default=5, type=int, help='Runs per measure, the best one is kept')
+    parser.add_argument('--screen_height', default=224, type=int, help='Emulator screen height')
+    parser.add_argument('--screen_width', default=256, type=int, help='Emulator screen width')
+    parser.add_argument('--frame_height', default=84, type=int, help='Resized frame height')
+    parser.add_argument('--frame_width', default=84, type=int, help='Resized frame width')
+    parser.add_argument('--tolerance', default=1, type=int, help='Max allowed difference with PIL')
+    args = parser.parse_args()
+
+    new_size = (args.frame_height, args.frame_width)
+    frames = make_frames(args.num_frames, (args.screen_height, args.screen_width, 3))
+    atari_processor = AtariPreprocessor(new_size)
+
+    expected = np.array([pil_process_state_for_memory(frame, new_size) for frame in frames])
+    output = atari_processor.process_batch_for_memory(frames)
+    diff = np.abs(output.astype(np.int16) - expected)
+    print("max diff %d, mean diff %.4f, differing pixels %.2f%%"
+        % (diff.max(), diff.mean(), 100.0 * np.count_nonzero(diff) / diff.size))
+
+    pil_time = time_per_frame(lambda: [pil_process_state_for_memory(frame, new_size) for frame in frames],
+        args.num_frames, args.repeat)
+    numpy_time = time_per_frame(lambda: [atari_processor.process_state_for_memory(frame) for frame in frames],
+        args.num_frames, args.repeat)
+    out = np.empty_like(output)
+    batch_time = time_per_frame(lambda: atari_processor.process_batch_for_memory(frames, out),
+        args.num_frames, args.repeat)
+    print("pil %.1f us/frame" % (pil_time * 1e6))
+    print("numpy %.1f us/frame (%.2fx)" % (numpy_time * 1e6, pil_time / numpy_time))
+    print("numpy batch %.1f us/frame (%.2fx)" % (batch_time * 1e6, pil_time / batch_time))
+
+    if diff.max() > args.tolerance:
+        print("FAILED: output differs from PIL by more than %d" % args.tolerance)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,4 +3,6 @@ from . import dqn
 from . import objectives
 from . import policy
 from . import preprocessors
+from . import traces
 from . import utils
+from . import vec_env
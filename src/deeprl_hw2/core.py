@@ -1,4 +1,14 @@
 """Core classes."""
+import collections
+import copy
+import ctypes
+import json
+import mmap
+import os
+import pickle
+import time
+import zlib
+
 import numpy as np
 from PIL import Image
 
@@ -39,6 +49,43 @@ class Sample:
         self.next_state = next_state
         self.is_terminal = is_terminal
 
+class Batch:
+    """Represents a minibatch of samples stored as stacked arrays.
+
+    This is the batched counterpart of Sample. Every field holds the
+    values of all samples in the minibatch stacked along the first
+    axis, so the arrays can be fed to the network directly.
+
+    Parameters
+    ----------
+    states: np.ndarray
+      Array of shape (batch_size, history_length, rows, cols).
+    actions: np.ndarray
+      Array of shape (batch_size,) holding the action indexes.
+    rewards: np.ndarray
+      Array of shape (batch_size,) holding the rewards.
+    next_states: np.ndarray
+      Array with the same shape and type as states.
+    is_terminal: np.ndarray
+      Boolean array of shape (batch_size,).
+    indexes: np.ndarray, optional
+      The replay memory indexes the samples were drawn from.
+    weights: np.ndarray, optional
+      Importance-sampling weights of the samples. None means every
+      sample has weight one.
+    """
+    def __init__(self, states, actions, rewards, next_states, is_terminal, indexes=None, weights=None):
+        self.states = states
+        self.actions = actions
+        self.rewards = rewards
+        self.next_states = next_states
+        self.is_terminal = is_terminal
+        self.indexes = indexes
+        self.weights = weights
+
+    def __len__(self):
+        return len(self.actions)
+
 class Preprocessor:
     """Preprocessor base class.
 
@@ -158,6 +205,127 @@ class Preprocessor:
         """
         pass
 
+class CompressedFrames:
+    """Fixed number of uint8 frames stored zlib compressed.
+
+    Drop-in replacement for the (memory_size, rows, cols) screens
+    array of the ReplayMemory. Each frame is compressed on its own, so
+    overwriting a slot of the ring buffer never touches its
+    neighbours. Recently decompressed frames are kept in a small LRU
+    cache, which absorbs the frames shared by overlapping frame stacks
+    and frequently replayed samples.
+
+    84x84 SNES frames compress 4-12x at level 1. Decompression costs
+    about 15us per frame, and the throughput target is 150 batches of
+    32 per second on one core with history length 4 (about 200 in
+    practice, against 700 for the uncompressed array). That is still
+    well above what the learner consumes with train_freq 4.
+
+    Parameters
+    ----------
+    size: int
+      Number of frames.
+    frame_shape: tuple(int, int)
+      Shape of a single frame.
+    cache_size: int
+      Number of decompressed frames kept in the LRU cache.
+    level: int
+      zlib compression level.
+    """
+    def __init__(self, size, frame_shape, cache_size=4096, level=1):
+        self.frames = [None] * size
+        self.frame_shape = tuple(frame_shape)
+        self.cache_size = cache_size
+        self.level = level
+        self.cache = collections.OrderedDict()
+        self.compressed_bytes = 0
+        self._empty = np.zeros(self.frame_shape, dtype = np.uint8)
+
+    @property
+    def shape(self):
+        return (len(self.frames),) + self.frame_shape
+
+    @property
+    def nbytes(self):
+        """Bytes used by the compressed frames and the cache."""
+        return self.compressed_bytes + len(self.cache) * self._empty.nbytes
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __setitem__(self, index, frame):
+        data = zlib.compress(np.ascontiguousarray(frame, dtype = np.uint8), self.level)
+        if self.frames[index] is not None:
+            self.compressed_bytes -= len(self.frames[index])
+        self.frames[index] = data
+        self.compressed_bytes += len(data)
+        self.cache.pop(index, None)
+
+    def __getitem__(self, key):
+        # supports a frame index or the slices used by get_state
+        if isinstance(key, tuple):
+            key, rest = key[0], key[1:]
+        else:
+            rest = ()
+        if isinstance(key, slice):
+            frames = self.take(np.arange(*key.indices(len(self.frames))))
+        else:
+            frames = self._get(key)
+        return frames[(slice(None),) + rest] if rest else frames
+
+    def _get(self, index):
+        frame = self.cache.get(index)
+        if frame is not None:
+            self.cache.move_to_end(index)
+            return frame
+        data = self.frames[index]
+        if data is None:
+            return self._empty
+        frame = np.frombuffer(zlib.decompress(data), dtype = np.uint8).reshape(self.frame_shape)
+        self.cache[index] = frame
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last = False)
+        return frame
+
+    def take(self, indexes, axis = 0, out = None, mode = 'raise'):
+        """Gather frames like np.take along the first axis.
+
+        Indexes have to be in range, whatever the mode.
+        """
+        assert axis == 0
+        indexes = np.asarray(indexes)
+        if out is None:
+            out = np.empty(indexes.shape + self.frame_shape, dtype = np.uint8)
+        frames = out.reshape((-1,) + self.frame_shape)
+        for i, index in enumerate(indexes.ravel().tolist()):
+            frames[i] = self._get(index)
+        return out
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['cache'] = collections.OrderedDict()
+        return state
+
+def _resident_bytes(array):
+    """Bytes of a memory-mapped array that are resident in RAM.
+
+    Asks the kernel with mincore, so this counts whole pages. Where
+    mincore isn't available, the mapped size is returned.
+    """
+    if array.nbytes == 0:
+        return 0
+    try:
+        mincore = ctypes.CDLL(None, use_errno = True).mincore
+    except (OSError, AttributeError):
+        return array.nbytes
+    mincore.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p)
+    start = array.ctypes.data - array.ctypes.data % mmap.PAGESIZE
+    length = array.ctypes.data + array.nbytes - start
+    pages = np.zeros(-(-length // mmap.PAGESIZE), dtype = np.uint8)
+    if mincore(start, length, pages.ctypes.data) != 0:
+        return array.nbytes
+    return int(np.count_nonzero(pages & 1)) * mmap.PAGESIZE
+
 class ReplayMemory:
     """Interface for replay memories.
 
@@ -194,6 +362,9 @@ class ReplayMemory:
       Return list of samples from the memory. Each class will
       implement a different method of choosing the
       samples. Optionally, specify the sample indexes manually.
+    sample_batch(batch_size, indexes=None)
+      Same as sample, but return a single Batch of stacked arrays
+      instead of a list of Sample objects.
     clear()
       Reset the memory. Deletes all references to the samples.
     """
@@ -207,50 +378,830 @@ class ReplayMemory:
 
         We recommend using a list as a ring buffer. Just track the
         index where the next sample should be inserted in the list.
+
+        If args.memory_dir is set, the arrays are memory-mapped .npy
+        files in that directory instead of living in RAM, so the OS
+        page cache decides what stays resident. An existing memory in
+        the directory is reopened and continues where it stopped.
+
+        If args.compress_memory is set, the screens are stored zlib
+        compressed in a CompressedFrames instead.
         """
         self.memory_size = args.replay_memory_size
         self.history_length = args.num_frames
-        self.actions = np.zeros(self.memory_size, dtype = np.int8)
-        self.rewards = np.zeros(self.memory_size)
-        self.screens = np.zeros((self.memory_size, args.frame_height, args.frame_width), dtype = np.uint8)
-        self.terminals = np.zeros(self.memory_size, dtype = np.bool)
-        self.current = 0
+        self.memory_dir = args.memory_dir
+        if self.memory_dir:
+            if args.compress_memory:
+                raise ValueError('compressed replay memories can not be memory-mapped')
+            os.makedirs(self.memory_dir, exist_ok=True)
+        self.actions = self._allocate('actions', (self.memory_size,), np.int8)
+        self.rewards = self._allocate('rewards', (self.memory_size,), np.float64)
+        if args.compress_memory:
+            self.screens = CompressedFrames(self.memory_size, (args.frame_height, args.frame_width),
+                args.memory_cache_size)
+        else:
+            self.screens = self._allocate('screens', (self.memory_size, args.frame_height, args.frame_width), np.uint8)
+        self.terminals = self._allocate('terminals', (self.memory_size,), np.bool_)
+        # kept in an array so that memory-mapped memories persist it
+        self._cursor = self._allocate('cursor', (1,), np.int64)
+        self._frame_buffer = None
+        self._rebuild_valid()
+        self._reset_stats()
+
+    def _allocate(self, name, shape, dtype):
+        """Allocate a zeroed array in RAM or as a memory-mapped file."""
+        if not self.memory_dir:
+            return np.zeros(shape, dtype = dtype)
+        path = os.path.join(self.memory_dir, name + '.npy')
+        if not os.path.exists(path):
+            return np.lib.format.open_memmap(path, mode = 'w+', dtype = dtype, shape = shape)
+        array = np.lib.format.open_memmap(path, mode = 'r+')
+        if array.shape != shape or array.dtype != dtype:
+            raise ValueError('%s has shape %s and type %s, expected %s and %s'
+                % (path, array.shape, array.dtype, shape, np.dtype(dtype)))
+        return array
+
+    @property
+    def current(self):
+        """Total number of frames appended so far."""
+        return int(self._cursor[0])
+
+    @current.setter
+    def current(self, value):
+        self._cursor[0] = value
 
     def append(self, state, action, reward, is_terminal):
-        self.actions[self.current % self.memory_size] = action
-        self.rewards[self.current % self.memory_size] = reward
-        self.screens[self.current % self.memory_size] = state
-        self.terminals[self.current % self.memory_size] = is_terminal
+        index = self.current % self.memory_size
+        # the agent stores the last frame of an episode as terminal too
+        if is_terminal and not (self.current > 0 and self.terminals[index - 1]):
+            self.num_episodes += 1
+        self.actions[index] = action
+        self.rewards[index] = reward
+        self.screens[index] = state
+        self.terminals[index] = is_terminal
         # img = Image.fromarray(state, mode = 'L')
         # path = "/Users/bochen/Downloads/tmp/%05d-%s.png" % (self.current, is_terminal)
         # img.save(path)
-        self.current += 1
+        self._cursor[0] += 1
+        self._update_valid(index)
+
+    def extend(self, screens, actions, rewards, terminals):
+        """Append many frames at once.
+
+        Same as calling append for every frame, but the arrays are
+        written with one vectorized copy and the valid indexes are
+        recomputed once at the end. For a PrioritizedReplayMemory
+        that resets all priorities to the max priority.
+        """
+        count = len(actions)
+        # episodes are counted like append does, before the last frame is overwritten
+        terminals = np.asarray(terminals, dtype = np.bool_)
+        previous = np.empty(count, dtype = np.bool_)
+        previous[:1] = self.current > 0 and self.terminals[(self.current - 1) % self.memory_size]
+        previous[1:] = terminals[:-1]
+        self.num_episodes += int(np.count_nonzero(terminals & ~previous))
+        # only the newest memory_size frames survive
+        keep = min(count, self.memory_size)
+        positions = (self.current + np.arange(count - keep, count)) % self.memory_size
+        self.actions[positions] = actions[count - keep:]
+        self.rewards[positions] = rewards[count - keep:]
+        self.terminals[positions] = terminals[count - keep:]
+        if isinstance(self.screens, np.ndarray):
+            self.screens[positions] = screens[count - keep:]
+        else:
+            for position, screen in zip(positions.tolist(), screens[count - keep:]):
+                self.screens[position] = screen
+        self._cursor[0] += count
+        self._rebuild_valid()
+
+    def _update_valid(self, index):
+        """Update the valid sample indexes after writing a frame at index.
+
+        Index i can be sampled when the frames [i - history_length + 1,
+        i + 1] are all in the memory, were written in this order and the
+        state frames contain no episode end.
+        """
+        # the new frame breaks every stack that reaches it from older frames
+        for i in range(self.history_length):
+            self._remove_valid((index + i) % self.memory_size)
+        # while the previous frame just got its next frame
+        previous = self.current - 2
+        if previous >= self.history_length - 1:
+            start = (previous - self.history_length + 1) % self.memory_size
+            end = start + self.history_length
+            terminal = self.terminals[start:end].any()
+            if end > self.memory_size:
+                terminal = terminal or self.terminals[:end - self.memory_size].any()
+            if not terminal:
+                self._add_valid(previous % self.memory_size)
+
+    def _add_valid(self, index):
+        if self._valid_position[index] >= 0:
+            return
+        self._valid_indexes[self._num_valid] = index
+        self._valid_position[index] = self._num_valid
+        self._num_valid += 1
+
+    def _remove_valid(self, index):
+        position = self._valid_position[index]
+        if position < 0:
+            return
+        # move the last valid index into the hole
+        self._num_valid -= 1
+        last = self._valid_indexes[self._num_valid]
+        self._valid_indexes[position] = last
+        self._valid_position[last] = position
+        self._valid_position[index] = -1
+
+    def _rebuild_valid(self):
+        """Recompute the valid sample indexes from the stored frames."""
+        self._valid_indexes = np.empty(self.memory_size, dtype = np.int64)
+        self._valid_position = np.full(self.memory_size, -1, dtype = np.int64)
+        self._num_valid = 0
+        current = self.current
+        first = max(0, current - self.memory_size)
+        # candidates need history_length - 1 older frames and a next frame
+        candidates = np.arange(first + self.history_length - 1, current - 1)
+        if len(candidates) == 0:
+            return
+        # number of terminals in the state of every candidate
+        logical = np.arange(first, current)
+        terminal_count = np.concatenate(([0], np.cumsum(self.terminals[logical % self.memory_size])))
+        offset = candidates - first
+        in_state = terminal_count[offset + 1] - terminal_count[offset + 1 - self.history_length]
+        valid = candidates[in_state == 0] % self.memory_size
+        self._num_valid = len(valid)
+        self._valid_indexes[:self._num_valid] = valid
+        self._valid_position[valid] = np.arange(self._num_valid)
+
+    def flush(self):
+        """Write memory-mapped arrays back to disk. No-op in RAM."""
+        if self.memory_dir:
+            for array in (self.actions, self.rewards, self.screens, self.terminals, self._cursor):
+                array.flush()
 
     def get_state(self, index):
-        state = self.screens[index - self.history_length + 1:index + 1, :, :]
-        # history dimention last
-        return np.transpose(state, (1, 2, 0)) 
+        return self._get_frames(index)[:-1]
 
-    def sample(self, batch_size):
-        samples = []
-        indexes = []
-        # ensure enough frames to sample
-        assert self.current > self.history_length
-        # -1 because still need next frame
-        end = min(self.current, self.memory_size) - 1
+    def _get_frames(self, index):
+        """Return the state and next state frames of a sample.
 
-        while len(indexes) < batch_size: 
-            index = np.random.randint(self.history_length - 1, end)
-            # sampled state shouldn't contain episode end
-            if self.terminals[index - self.history_length + 1: index + 1].any():
-                continue
-            indexes.append(index)
+        The frames are gathered through _frame_indexes, so stacks that
+        wrap around the end of the memory are built right. The history
+        dimension comes first, like in the network input.
+        """
+        return self.screens.take(self._frame_indexes(np.array([index]))[0], axis = 0)
 
-        for idx in indexes:
-            new_sample = Sample(self.get_state(idx), self.actions[idx],
-                self.rewards[idx], self.get_state(idx + 1), self.terminals[idx])
+    def sample_indexes(self, batch_size):
+        """Draw batch_size valid sample indexes at once.
+
+        The memory keeps the set of valid indexes up to date on every
+        append, so this is a single uniform draw from that set.
+        """
+        # ensure enough frames to sample
+        assert self._num_valid > 0
+        return self._valid_indexes[np.random.randint(0, self._num_valid, size = batch_size)]
+
+    def sample(self, batch_size):
+        samples = []
+        for idx in self.sample_indexes(batch_size):
+            frames = self._get_frames(idx)
+            new_sample = Sample(frames[:-1], self.actions[idx],
+                self.rewards[idx], frames[1:], self.terminals[idx])
             samples.append(new_sample)
         return samples
 
+    def sample_batch(self, batch_size, indexes = None):
+        """Sample a minibatch as stacked arrays.
+
+        The frames of all samples are gathered with a single fancy
+        index into a preallocated uint8 buffer of shape
+        (batch_size, history_length + 1, rows, cols), the states and
+        next states being views of it with shape (batch_size,
+        history_length, rows, cols). The buffer is reused by the next
+        call, copy the arrays if they have to outlive it.
+
+        Parameters
+        ----------
+        batch_size: int
+          Number of samples to draw.
+        indexes: np.ndarray, optional
+          Sample these memory indexes instead of drawing random ones.
+
+        Returns
+        -------
+        deeprl_hw2.core.Batch
+        """
+        start = time.perf_counter()
+        if indexes is None:
+            indexes = self.sample_indexes(batch_size)
+        batch = self._gather(indexes)
+        self._record_sample(start)
+        return batch
+
+    def _gather(self, indexes):
+        """Build the Batch of the given sample indexes."""
+        frames = self._get_batch_buffer(len(indexes))
+
+        # the indexes are already wrapped, and with the default 'raise'
+        # mode np.take copies through a temporary instead of writing to out
+        self.screens.take(self._frame_indexes(indexes), axis = 0, out = frames, mode = 'wrap')
+        # history dimension first, like the network input, so the states
+        # and next states are overlapping views of the gathered frames
+        return Batch(frames[:, :-1], self.actions[indexes], self.rewards[indexes],
+            frames[:, 1:], self.terminals[indexes], indexes)
+
+    # upper edges in seconds of the sample latency histogram buckets
+    latency_buckets = 10 ** np.arange(-5, 0.01, 0.25)
+
+    def _reset_stats(self):
+        self.num_episodes = 0
+        self._reset_interval_stats()
+
+    def _reset_interval_stats(self):
+        self.sampled_batches = 0
+        self.rejected_draws = 0
+        self.sample_latency = np.zeros(len(self.latency_buckets) + 1, dtype = np.int64)
+
+    def _record_sample(self, start):
+        self.sampled_batches += 1
+        self.sample_latency[np.searchsorted(self.latency_buckets, time.perf_counter() - start)] += 1
+
+    def _occupancy(self):
+        """Return the number of stored frames and of wraparounds."""
+        return min(self.current, self.memory_size), self.current // self.memory_size
+
+    def _arrays(self):
+        arrays = (self.screens, self.actions, self.rewards, self.terminals,
+            getattr(self, '_valid_indexes', None), getattr(self, '_valid_position', None))
+        return [array for array in arrays if array is not None]
+
+    def memory_bytes(self):
+        """Bytes of the memory resident in RAM.
+
+        Only the pages of a memory-mapped memory that are in the OS
+        page cache count. A compressed memory counts its compressed
+        frames and its cache of decompressed ones.
+        """
+        return sum(_resident_bytes(array) if isinstance(array, np.memmap) else array.nbytes
+            for array in self._arrays())
+
+    def mapped_bytes(self):
+        """Bytes the memory arrays take, in RAM or on disk."""
+        return sum(array.nbytes for array in self._arrays())
+
+    def metrics(self):
+        """Return a dict of statistics about the memory.
+
+        fill, wraparounds, episodes, bytes (resident in RAM) and
+        bytes_mapped (the size of the arrays) describe the memory now.
+        sample_batches, rejected_per_batch and the sample latency
+        percentiles (in seconds, upper bucket edges) cover the
+        sample_batch calls since the previous call to metrics.
+        """
+        filled, wraparounds = self._occupancy()
+        metrics = {
+            'fill': filled / float(self.memory_size),
+            'wraparounds': wraparounds,
+            'episodes': self.num_episodes,
+            'bytes': self.memory_bytes(),
+            'bytes_mapped': self.mapped_bytes(),
+            'sample_batches': self.sampled_batches,
+            'rejected_per_batch': self.rejected_draws / float(max(self.sampled_batches, 1)),
+        }
+        if self.sampled_batches > 0:
+            cumulative = np.cumsum(self.sample_latency) / float(self.sampled_batches)
+            edges = np.append(self.latency_buckets, np.inf)
+            for percentile in (50, 90, 99):
+                metrics['sample_latency_p%d' % percentile] = edges[np.searchsorted(cumulative, percentile / 100.0)]
+        self._reset_interval_stats()
+        return metrics
+
+    def _frame_indexes(self, indexes):
+        """Return the (len(indexes), history_length + 1) frames of samples."""
+        # state uses frames [idx - h + 1, idx], next state [idx - h + 2, idx + 1]
+        return (indexes[:, None] + np.arange(1 - self.history_length, 2)) % self.memory_size
+
+    def _get_batch_buffer(self, batch_size):
+        # grow the buffer to the largest batch seen, smaller batches use a prefix
+        if self._frame_buffer is None or len(self._frame_buffer) < batch_size:
+            _, rows, cols = self.screens.shape
+            self._frame_buffer = np.empty((batch_size, self.history_length + 1, rows, cols), dtype = np.uint8)
+        return self._frame_buffer[:batch_size]
+
+    def __getstate__(self):
+        # batch buffers are scratch space and the valid indexes are
+        # rebuilt on load, don't pickle them
+        state = self.__dict__.copy()
+        for key in ('_frame_buffer', '_valid_indexes', '_valid_position', '_num_valid'):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        # memories pickled before the cursor array kept a plain int
+        if 'current' in state:
+            state['_cursor'] = np.array([state.pop('current')], dtype = np.int64)
+        state.setdefault('memory_dir', '')
+        state.setdefault('num_episodes', 0)
+        self.__dict__.update(state)
+        self._frame_buffer = None
+        self._rebuild_valid()
+        self._reset_interval_stats()
+
     def clear(self):
         self.current = 0
+        self._rebuild_valid()
+        self._reset_stats()
+
+
+MEMORY_FORMAT_VERSION = 1
+
+def save_memory(memory, path, chunk_size=65536):
+    """Write a replay memory snapshot to the directory path.
+
+    A snapshot is a header.json with the memory layout plus one .npy
+    file per array (screens, actions, rewards, terminals). Arrays are
+    copied chunk_size frames at a time, so saving never holds a second
+    copy of the memory in RAM. The header is written last, a directory
+    without one is an incomplete snapshot.
+
+    Parameters
+    ----------
+    memory: deeprl_hw2.core.ReplayMemory
+      The memory to save.
+    path: str
+      Directory of the snapshot, created if needed.
+    chunk_size: int
+      Number of frames copied at a time.
+    """
+    # a memory-mapped memory gets its own files up to date first
+    memory.flush()
+    os.makedirs(path, exist_ok=True)
+    header_path = os.path.join(path, 'header.json')
+    if os.path.exists(header_path):
+        os.remove(header_path)
+    # slots that were never written stay sparse in the files
+    filled = min(memory.current, memory.memory_size)
+    for name in ('screens', 'actions', 'rewards', 'terminals'):
+        source = getattr(memory, name)
+        shape = (memory.memory_size,) + tuple(source.shape[1:])
+        dtype = np.uint8 if name == 'screens' else source.dtype
+        target = np.lib.format.open_memmap(os.path.join(path, name + '.npy'),
+            mode = 'w+', dtype = dtype, shape = shape)
+        for start in range(0, filled, chunk_size):
+            end = min(start + chunk_size, filled)
+            target[start:end] = source[start:end]
+        target.flush()
+        del target
+    header = {
+        'version': MEMORY_FORMAT_VERSION,
+        'memory_size': memory.memory_size,
+        'history_length': memory.history_length,
+        'current': memory.current,
+    }
+    with open(header_path, 'w') as f:
+        json.dump(header, f)
+
+def load_memory(path, mmap_mode='r'):
+    """Open a replay memory snapshot written by save_memory.
+
+    With the default mmap_mode the arrays are memory-mapped read-only,
+    so opening is nearly free and frames are paged in as they are
+    sampled. Use mmap_mode='c' to be able to append (copy-on-write)
+    or None to read the whole memory into RAM.
+
+    Returns
+    -------
+    deeprl_hw2.core.ReplayMemory
+    """
+    with open(os.path.join(path, 'header.json')) as f:
+        header = json.load(f)
+    if header['version'] != MEMORY_FORMAT_VERSION:
+        raise ValueError('%s has replay memory format version %s, expected %s'
+            % (path, header['version'], MEMORY_FORMAT_VERSION))
+    memory = ReplayMemory.__new__(ReplayMemory)
+    memory.memory_size = header['memory_size']
+    memory.history_length = header['history_length']
+    memory.memory_dir = ''
+    for name in ('screens', 'actions', 'rewards', 'terminals'):
+        setattr(memory, name, np.load(os.path.join(path, name + '.npy'), mmap_mode = mmap_mode))
+    memory._cursor = np.array([header['current']], dtype = np.int64)
+    memory._frame_buffer = None
+    memory._rebuild_valid()
+    memory._reset_stats()
+    return memory
+
+def convert_memory(pickle_path, path):
+    """Convert a pickled replay memory into a snapshot directory."""
+    with open(pickle_path, 'rb') as mdump:
+        memory = pickle.load(mdump)
+    save_memory(memory, path)
+
+class SumTree:
+    """Array-backed binary sum tree over a fixed number of priorities.
+
+    Leaves hold the priorities and every inner node holds the sum of
+    its two children, with the root at index 1. Updating a priority and
+    finding the leaf for a prefix sum are both O(log N), and both are
+    vectorized over a batch of indexes.
+
+    Parameters
+    ----------
+    capacity: int
+      Number of priorities stored in the tree.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.num_leaves = 1
+        while self.num_leaves < capacity:
+            self.num_leaves *= 2
+        self.tree = np.zeros(2 * self.num_leaves)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def __getitem__(self, indexes):
+        return self.tree[np.asarray(indexes) + self.num_leaves]
+
+    def set(self, index, priority):
+        """Set the priority of a single index."""
+        node = index + self.num_leaves
+        self.tree[node] = priority
+        node //= 2
+        while node >= 1:
+            self.tree[node] = self.tree[2 * node] + self.tree[2 * node + 1]
+            node //= 2
+
+    def update(self, indexes, priorities):
+        """Set the priorities of the given indexes."""
+        if len(indexes) == 0:
+            return
+        nodes = np.unique(np.asarray(indexes) + self.num_leaves)
+        # with duplicate indexes the last priority wins
+        self.tree[np.asarray(indexes) + self.num_leaves] = priorities
+        # recompute the sums instead of adding deltas so that
+        # floating point error doesn't accumulate
+        nodes = np.unique(nodes // 2)
+        while nodes[0] >= 1:
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+            nodes = np.unique(nodes // 2)
+
+    def find(self, values):
+        """Return the indexes whose prefix sums contain the given values.
+
+        Parameters
+        ----------
+        values: np.ndarray
+          Values in [0, total).
+        """
+        values = np.array(values, dtype = np.float64)
+        nodes = np.ones(len(values), dtype = np.int64)
+        while len(nodes) > 0 and nodes[0] < self.num_leaves:
+            left = self.tree[2 * nodes]
+            go_right = values >= left
+            values -= left * go_right
+            nodes = 2 * nodes + go_right
+        return nodes - self.num_leaves
+
+class PrioritizedReplayMemory(ReplayMemory):
+    """Replay memory with proportional prioritized sampling.
+
+    Based on:
+
+    @article{schaul15_prioritized_experience_replay,
+    author =	 {Tom Schaul and John Quan and Ioannis Antonoglou and
+                  David Silver},
+    title =	 {Prioritized Experience Replay},
+    journal =	 {arXiv preprint arXiv:1511.05952},
+    year =	 2015,
+    }
+
+    Index i is drawn with probability p_i^alpha / sum_k p_k^alpha using
+    a SumTree. New samples get the largest priority seen so far, and
+    update_priorities sets p_i = |td_error_i| + epsilon after training
+    on them. Indexes that aren't valid samples have priority zero.
+
+    The batches carry importance-sampling weights (N * P(i))^-beta,
+    normalized by the largest weight in the batch. beta is annealed
+    linearly to 1 over args.priority_beta_steps batches.
+    """
+    def __init__(self, args):
+        self.alpha = args.priority_alpha
+        self.beta = args.priority_beta
+        self.beta_step = (1.0 - self.beta) / args.priority_beta_steps
+        self.epsilon = 1e-6
+        self.max_priority = 1.0
+        super(PrioritizedReplayMemory, self).__init__(args)
+
+    def _add_valid(self, index):
+        super(PrioritizedReplayMemory, self)._add_valid(index)
+        self.tree.set(index, self.max_priority ** self.alpha)
+
+    def _remove_valid(self, index):
+        if self._valid_position[index] >= 0:
+            super(PrioritizedReplayMemory, self)._remove_valid(index)
+            self.tree.set(index, 0)
+
+    def _rebuild_valid(self):
+        # priorities aren't stored, start all valid indexes at the max
+        super(PrioritizedReplayMemory, self)._rebuild_valid()
+        self.tree = SumTree(self.memory_size)
+        valid = self._valid_indexes[:self._num_valid]
+        self.tree.update(valid, np.full(len(valid), self.max_priority ** self.alpha))
+
+    def sample_indexes(self, batch_size):
+        """Draw indexes proportionally to their priority.
+
+        The total priority is split into batch_size equal segments and
+        one index is drawn from each.
+        """
+        assert self.tree.total > 0
+        indexes = np.empty(batch_size, dtype = np.int64)
+        missing = np.arange(batch_size)
+        while len(missing) > 0:
+            segment = self.tree.total / batch_size
+            values = (missing + np.random.rand(len(missing))) * segment
+            candidates = self.tree.find(np.minimum(values, np.nextafter(self.tree.total, 0)))
+            # rounding can land on a zero priority leaf next to a boundary
+            valid = self.tree[candidates] > 0
+            indexes[missing[valid]] = candidates[valid]
+            missing = missing[~valid]
+            self.rejected_draws += len(missing)
+        return indexes
+
+    def sample_batch(self, batch_size, indexes = None):
+        batch = super(PrioritizedReplayMemory, self).sample_batch(batch_size, indexes)
+        probabilities = self.tree[batch.indexes] / self.tree.total
+        weights = (self._num_valid * probabilities) ** -self.beta
+        batch.weights = weights / weights.max() if len(weights) > 0 else weights
+        self.beta = min(self.beta + self.beta_step, 1.0)
+        return batch
+
+    def update_priorities(self, indexes, td_errors):
+        """Set the priorities of sampled indexes from their TD errors.
+
+        Indexes that became unsampleable since they were drawn keep
+        their zero priority.
+        """
+        if len(indexes) == 0:
+            return
+        priorities = np.abs(td_errors) + self.epsilon
+        self.max_priority = max(self.max_priority, priorities.max())
+        live = self._valid_position[indexes] >= 0
+        self.tree.update(indexes[live], priorities[live] ** self.alpha)
+
+    def clear(self):
+        self.max_priority = 1.0
+        super(PrioritizedReplayMemory, self).clear()
+
+class SegmentedReplayMemory(ReplayMemory):
+    """Replay memory split into one ring buffer per environment.
+
+    The memory is split into num_writers equal segments, one per
+    environment, so the frames of different environments never
+    interleave. Each environment appends through its own
+    writer(writer_id), which fills the next slot of its segment and
+    then bumps the segment's cursor.
+
+    Sampling is uniform over the valid indexes of all segments, with
+    the same validity rule as ReplayMemory.
+
+    Parameters
+    ----------
+    args: argparse.Namespace
+      Same settings as ReplayMemory, replay_memory_size is split
+      evenly between the writers.
+    num_writers: int
+      Number of environments appending to the memory.
+    """
+    # oldest frames of a segment that are never sampled
+    sample_guard = 0
+
+    def __init__(self, args, num_writers):
+        self.num_writers = num_writers
+        self.segment_size = args.replay_memory_size // num_writers
+        self.memory_size = self.segment_size * num_writers
+        self.history_length = args.num_frames
+        if self.segment_size <= self.history_length:
+            raise ValueError("replay_memory_size %d is too small for %d writers, every writer needs more than %d frames"
+                % (args.replay_memory_size, num_writers, self.history_length))
+        # small segments keep at most half of their sampleable frames as guard
+        self.sample_guard = min(self.sample_guard, (self.segment_size - self.history_length) // 2)
+        self.frame_shape = (args.frame_height, args.frame_width)
+        self.memory_dir = ''
+        self.writer_id = 0
+        self._attach(self._allocate(self._layout()[1]))
+        self.clear()
+
+    def _layout(self):
+        """Return the offsets of the arrays in the block and its size."""
+        arrays = [
+            ('screens', (self.memory_size,) + self.frame_shape, np.uint8),
+            ('actions', (self.memory_size,), np.int8),
+            ('rewards', (self.memory_size,), np.float64),
+            ('terminals', (self.memory_size,), np.bool_),
+            ('cursors', (self.num_writers,), np.int64),
+            ('episodes', (self.num_writers,), np.int64),
+        ]
+        layout = []
+        offset = 0
+        for name, shape, dtype in arrays:
+            layout.append((name, shape, dtype, offset))
+            # keep every array 8 byte aligned
+            offset += -(-int(np.prod(shape)) * np.dtype(dtype).itemsize // 8) * 8
+        return layout, offset
+
+    def _allocate(self, size):
+        """Return the buffer holding all the arrays."""
+        return np.zeros(size, dtype = np.uint8)
+
+    def _attach(self, buffer):
+        for name, shape, dtype, offset in self._layout()[0]:
+            setattr(self, name, np.ndarray(shape, dtype = dtype, buffer = buffer, offset = offset))
+        self._frame_buffer = None
+
+    def writer(self, writer_id):
+        """Return a view of the memory that appends to segment writer_id."""
+        memory = copy.copy(self)
+        memory.writer_id = writer_id
+        memory._frame_buffer = None
+        return memory
+
+    @property
+    def current(self):
+        """Total number of frames appended by all writers."""
+        return int(self.cursors.sum())
+
+    @property
+    def num_episodes(self):
+        return int(self.episodes.sum())
+
+    def _reset_stats(self):
+        self.episodes[:] = 0
+        self._reset_interval_stats()
+
+    def _occupancy(self):
+        return (int(np.minimum(self.cursors, self.segment_size).sum()),
+            int((self.cursors // self.segment_size).sum()))
+
+    def append(self, state, action, reward, is_terminal):
+        cursor = self.cursors[self.writer_id]
+        index = self.writer_id * self.segment_size + cursor % self.segment_size
+        previous = self.writer_id * self.segment_size + (cursor - 1) % self.segment_size
+        # the agent stores the last frame of an episode as terminal too
+        if is_terminal and not (cursor > 0 and self.terminals[previous]):
+            self.episodes[self.writer_id] += 1
+        self.actions[index] = action
+        self.rewards[index] = reward
+        self.screens[index] = state
+        self.terminals[index] = is_terminal
+        # publish the frame only once it is completely written
+        self.cursors[self.writer_id] = cursor + 1
+
+    def extend(self, screens, actions, rewards, terminals):
+        for frame in zip(screens, actions, rewards, terminals):
+            self.append(*frame)
+
+    def _rebuild_valid(self):
+        # validity is checked when sampling
+        pass
+
+    def _frame_indexes(self, indexes):
+        segment_start = indexes - indexes % self.segment_size
+        offsets = np.arange(1 - self.history_length, 2)
+        return segment_start[:, None] + (indexes[:, None] - segment_start[:, None] + offsets) % self.segment_size
+
+    def _draw(self, batch_size, cursors):
+        """Draw (segments, positions) of valid samples given the cursors.
+
+        Positions count the frames appended to a segment, so position
+        p is stored at slot p % segment_size.
+        """
+        first = np.maximum(cursors - self.segment_size + self.sample_guard, 0) + self.history_length - 1
+        # -1 because still need next frame
+        counts = np.maximum(cursors - 1 - first, 0)
+        if counts.sum() == 0:
+            raise ValueError("Not enough frames in the memory to sample, %d appended" % cursors.sum())
+        segments = np.empty(batch_size, dtype = np.int64)
+        positions = np.empty(batch_size, dtype = np.int64)
+        missing = np.arange(batch_size)
+        while len(missing) > 0:
+            candidate_segments = np.random.choice(self.num_writers, size = len(missing), p = counts / counts.sum())
+            candidates = first[candidate_segments] + (np.random.rand(len(missing)) * counts[candidate_segments]).astype(np.int64)
+            # sampled state shouldn't contain episode end
+            window = (candidates[:, None] + np.arange(1 - self.history_length, 1)) % self.segment_size
+            window += (candidate_segments * self.segment_size)[:, None]
+            valid = ~self.terminals[window].any(axis = 1)
+            segments[missing[valid]] = candidate_segments[valid]
+            positions[missing[valid]] = candidates[valid]
+            missing = missing[~valid]
+            self.rejected_draws += int((~valid).sum())
+        return segments, positions
+
+    def sample_indexes(self, batch_size):
+        segments, positions = self._draw(batch_size, self.cursors.copy())
+        return segments * self.segment_size + positions % self.segment_size
+
+    def clear(self):
+        """Reset all segments. Only safe while no writer is running."""
+        self.cursors[:] = 0
+        self._reset_stats()
+
+class SharedReplayMemory(SegmentedReplayMemory):
+    """Segmented replay memory in shared memory, filled by several processes.
+
+    Each actor process appends to its own segment through its own
+    writer(writer_id), so writers never contend, and publishes a
+    frame by bumping its cursor once the frame is written. There are
+    no locks.
+
+    Since the writers keep running while the learner gathers a batch,
+    the newest and oldest frames of every segment are only trusted up
+    to the cursors read before and after the gather; samples whose
+    frames were overwritten in between are redrawn.
+
+    The instance is picklable, unpickling attaches to the same shared
+    memory block, so it can be handed to multiprocessing workers. The
+    block takes the full memory size in /dev/shm, which has to be
+    large enough, and is freed by close() on the instance that created
+    it.
+
+    Parameters
+    ----------
+    args: argparse.Namespace
+      Same settings as ReplayMemory, replay_memory_size is split
+      evenly between the writers.
+    num_writers: int
+      Number of processes appending to the memory.
+    """
+    # writers rarely overwrite frames that are being gathered
+    sample_guard = 64
+
+    def _allocate(self, size):
+        # Python 3.8+, only needed by the shared memory
+        from multiprocessing import shared_memory
+        self.shm = shared_memory.SharedMemory(create = True, size = size)
+        self.owner = True
+        return self.shm.buf
+
+    def writer(self, writer_id):
+        memory = pickle.loads(pickle.dumps(self))
+        memory.writer_id = writer_id
+        return memory
+
+    def __getstate__(self):
+        return {
+            'name': self.shm.name,
+            'num_writers': self.num_writers,
+            'segment_size': self.segment_size,
+            'memory_size': self.memory_size,
+            'history_length': self.history_length,
+            'sample_guard': self.sample_guard,
+            'frame_shape': self.frame_shape,
+            'writer_id': self.writer_id,
+        }
+
+    def __setstate__(self, state):
+        name = state.pop('name')
+        self.__dict__.update(state)
+        self.memory_dir = ''
+        from multiprocessing import shared_memory
+        self.shm = shared_memory.SharedMemory(name = name)
+        self.owner = False
+        self._attach(self.shm.buf)
+        self._reset_interval_stats()
+
+    def close(self):
+        """Detach from the shared memory, the owner also frees it."""
+        for name, _, _, _ in self._layout()[0]:
+            setattr(self, name, None)
+        self._frame_buffer = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def memory_bytes(self):
+        # the block lives in shared memory, its pages are only resident once written
+        return _resident_bytes(np.frombuffer(self.shm.buf, dtype = np.uint8))
+
+    def mapped_bytes(self):
+        return self.shm.size
+
+    def sample_batch(self, batch_size, indexes = None):
+        if indexes is not None:
+            return super(SharedReplayMemory, self).sample_batch(batch_size, indexes)
+        start = time.perf_counter()
+        segments, positions = self._draw(batch_size, self.cursors.copy())
+        while True:
+            indexes = segments * self.segment_size + positions % self.segment_size
+            batch = self._gather(indexes)
+            # redraw the samples whose oldest frame was overwritten meanwhile,
+            # the slot of position cursor - segment_size may be half written
+            cursors = self.cursors.copy()
+            stale = positions - self.history_length + 1 <= cursors[segments] - self.segment_size
+            if not stale.any():
+                self._record_sample(start)
+                return batch
+            self.rejected_draws += int(stale.sum())
+            segments[stale], positions[stale] = self._draw(int(stale.sum()), cursors)
@@ -12,9 +12,14 @@ from keras.layers import (Activation, Convolution2D, Dense, Flatten, Input,
         Permute, merge, Lambda)
 from keras.models import Model
 from keras import backend as K
+import os
 import sys
 from gym import wrappers
+import multiprocessing
 import pickle
+import queue
+import threading
+import traceback
 
 config = tf.ConfigProto()
 config.gpu_options.allow_growth=True
@@ -24,7 +29,7 @@ K.get_session().run(tf.initialize_all_variables())
 
 """Main DQN agent."""
 
-def create_model(input_shape, num_actions, mode, model_name='q_network'):  # noqa: D103
+def create_model(input_shape, num_actions, mode, model_name='q_network', uint8_input=False):  # noqa: D103
     """Create the Q-network model.
 
     Use Keras to construct a keras.models.Model instance (you can also
@@ -40,12 +45,17 @@ def create_model(input_shape, num_actions, mode, model_name='q_network'):  # noq
     window: int
       Each input to the network is a sequence of frames. This value
       defines how many frames are in the sequence.
-    input_shape: tuple(int, int, int), rows, cols, channels
-      The expected input image size.
+    input_shape: tuple(int, int, int), channels, rows, cols
+      The expected input image size. The frames are stacked along the
+      first axis, like the replay memory gathers them, and the model
+      moves the channels last itself.
     num_actions: int
       Number of possible actions. Defined by the gym environment.
     model_name: str
       Useful when debugging. Makes the model show up nicer in tensorboard.
+    uint8_input: bool
+      If true the model takes uint8 frames as stored in the replay
+      memory and scales them to [0, 1] inside the graph.
 
     Returns
     -------
@@ -54,12 +64,18 @@ def create_model(input_shape, num_actions, mode, model_name='q_network'):  # noq
     """
     assert(mode in ("linear", "duel", "dqn"))
     with tf.variable_scope(model_name):
-        input_data = Input(shape = input_shape, name = "input")
+        if uint8_input:
+            input_data = Input(shape = input_shape, dtype = 'uint8', name = "input")
+            frames = Lambda(lambda x: tf.cast(x, tf.float32) / 255.0, name = "normalize")(input_data)
+        else:
+            input_data = Input(shape = input_shape, name = "input")
+            frames = input_data
+        frames = Permute((2, 3, 1), name = "channels_last")(frames)
         if mode == "linear":
-            flatten_hidden = Flatten(name = "flatten")(input_data)
+            flatten_hidden = Flatten(name = "flatten")(frames)
             output = Dense(num_actions, name = "output")(flatten_hidden)
         else:
-            h1 = Convolution2D(32, (8, 8), strides = 4, activation = "relu", name = "conv1")(input_data)
+            h1 = Convolution2D(32, (8, 8), strides = 4, activation = "relu", name = "conv1")(frames)
             h2 = Convolution2D(64, (4, 4), strides = 2, activation = "relu", name = "conv2")(h1)
             h3 = Convolution2D(64, (3, 3), strides = 1, activation = "relu", name = "conv3")(h2)
             flatten_hidden = Flatten(name = "flatten")(h3)
@@ -94,6 +110,199 @@ def save_scalar(step, name, value, writer):
     summary_value.tag = name
     writer.add_summary(summary, step)
 
+def evaluate_policy(env, calc_q_values, num_actions, num_episodes, max_episode_length=None,
+                    num_frames=4, new_size=(84, 84), uint8_input=False, policy=None):
+    """Play num_episodes greedily and return the reward mean and std.
+
+    Parameters
+    ----------
+    env: gym.Env
+      Environment returning raw screens.
+    calc_q_values: callable
+      Returns the (1, num_actions) Q-values of a (num_frames, rows,
+      cols) state.
+    num_actions: int
+      Number of actions.
+    num_episodes: int
+      Number of episodes to play.
+    max_episode_length: int
+      Episodes are cut after that many steps.
+    num_frames: int
+      Number of frames in a state.
+    new_size: tuple(int, int)
+      Size of the preprocessed frames.
+    uint8_input: bool
+      Whether the network takes uint8 frames.
+    policy: deeprl_hw2.policy.Policy, optional
+      Defaults to GreedyEpsilonPolicy(0.05).
+
+    Returns
+    -------
+    tuple(float, float)
+      Mean and standard deviation of the episode rewards.
+    """
+    print("Evaluation starts.")
+    if policy is None:
+        policy = GreedyEpsilonPolicy(0.05)
+    atari_processor = AtariPreprocessor(new_size)
+    history_processor = HistoryPreprocessor(num_frames - 1, dtype = np.uint8 if uint8_input else np.float32)
+    state = env.reset()
+
+    idx_episode = 1
+    episode_frames = 0
+    episode_reward = np.zeros(num_episodes)
+    t = 0
+
+    while idx_episode <= num_episodes:
+        t += 1
+        memory_frame, network_frame = atari_processor.process_frame(state)
+        action_state = history_processor.process_state_for_network(memory_frame if uint8_input else network_frame)
+        # only computed if the policy acts greedily
+        action = policy.select_action(LazyQValues(lambda: calc_q_values(action_state)[0], (num_actions,)))
+        state, reward, done, info = env.step(action)
+        episode_frames += 1
+        episode_reward[idx_episode-1] += reward 
+        if episode_frames > max_episode_length:
+            done = True
+        if done:
+            print("Eval: time %d, episode %d, length %d, reward %.0f" %
+                (t, idx_episode, episode_frames, episode_reward[idx_episode-1]))
+            sys.stdout.flush()
+            state = env.reset()
+            episode_frames = 0
+            idx_episode += 1
+            atari_processor.reset()
+            history_processor.reset()
+
+    reward_mean = np.mean(episode_reward)
+    reward_std = np.std(episode_reward)
+    print("Evaluation summury: num_episodes [%d], reward_mean [%.3f], reward_std [%.3f]" %
+        (num_episodes, reward_mean, reward_std))
+    sys.stdout.flush()
+
+    return reward_mean, reward_std
+
+def _evaluation_worker(args, num_actions, env_fn, requests, results):
+    """Evaluate the weights received on requests until None comes.
+
+    An error is put on results for AsyncEvaluator.poll to raise.
+    """
+    try:
+        env = env_fn()
+        input_shape = (args.num_frames, args.frame_height, args.frame_width)
+        q_network = create_model(input_shape, num_actions, args.net_mode, "EvalNet", args.uint8_input)
+        calc_q_values = lambda state: q_network.predict_on_batch(state[None, :, :, :])
+        while True:
+            request = requests.get()
+            if request is None:
+                break
+            t, weights = request
+            q_network.set_weights(weights)
+            reward_mean, reward_std = evaluate_policy(env, calc_q_values, num_actions, args.num_episodes_at_eval,
+                args.max_episode_length, args.num_frames, (args.frame_height, args.frame_width), args.uint8_input)
+            results.put((t, reward_mean, reward_std))
+    except KeyboardInterrupt:
+        pass
+    except BaseException as e:
+        try:
+            pickle.dumps(e)
+        except Exception:
+            # the queue can only carry picklable errors
+            e = RuntimeError("Evaluation failed:\n" + traceback.format_exc())
+        results.put(e)
+
+class AsyncEvaluator(object):
+    """Evaluates snapshots of the Q-network in another process.
+
+    The worker process has its own environment and network. submit
+    sends it a copy of the current weights and returns at once, and
+    poll collects the results that came back, so training never waits
+    for the evaluation. If the worker is still busy with the previous
+    snapshot, newer ones replace the pending one.
+
+    The worker is spawned rather than forked, it must not inherit the
+    tensorflow session of the learner.
+
+    Parameters
+    ----------
+    args: argparse.Namespace
+      Network and preprocessing settings, num_episodes_at_eval and
+      max_episode_length.
+    num_actions: int
+      Number of actions.
+    env_fn: callable
+      Picklable function creating the evaluation environment.
+    """
+    def __init__(self, args, num_actions, env_fn):
+        context = multiprocessing.get_context('spawn')
+        self.requests = context.Queue(maxsize=1)
+        self.results = context.Queue()
+        self.process = context.Process(target=_evaluation_worker,
+            args=(args, num_actions, env_fn, self.requests, self.results))
+        self.process.daemon = True
+        self.process.start()
+
+    def submit(self, t, q_network):
+        """Queue an evaluation of the current weights of q_network at step t."""
+        weights = q_network.get_weights()
+        while True:
+            try:
+                self.requests.put_nowait((t, weights))
+                return
+            except queue.Full:
+                pass
+            # drop the pending snapshot, the worker hasn't started it yet
+            try:
+                self.requests.get_nowait()
+            except queue.Empty:
+                pass
+
+    def poll(self):
+        """Return the (t, reward_mean, reward_std) evaluations done since the last call.
+
+        Raises the error the worker stopped on, if any.
+        """
+        results = []
+        while True:
+            try:
+                result = self.results.get_nowait()
+            except queue.Empty:
+                return results
+            if isinstance(result, BaseException):
+                raise result
+            results.append(result)
+
+    def close(self, timeout=None):
+        """Stop the worker once it's done with the pending evaluation.
+
+        Parameters
+        ----------
+        timeout: float, optional
+          Seconds to wait for the worker, which is terminated after
+          that. By default it is waited for.
+
+        Returns
+        -------
+        list(tuple)
+          The evaluations done since the last poll, the pending one
+          included.
+        """
+        # the request queue may be full with a snapshot, and the worker
+        # may die before taking it
+        while self.process.is_alive():
+            try:
+                self.requests.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        # nobody reads the requests anymore, don't wait to flush them at exit
+        self.requests.cancel_join_thread()
+        return self.poll()
+
 class DQNAgent:
     """Class implementing DQN.
 
@@ -134,12 +343,26 @@ class DQNAgent:
     """
     def __init__(self, args, num_actions):
         self.num_actions = num_actions
-        input_shape = (args.frame_height, args.frame_width, args.num_frames)
-        self.history_length = max(args.num_frames, args.num_frames_mv) - 1
-        self.history_processor = HistoryPreprocessor(self.history_length)
-        self.atari_processor = AtariPreprocessor()
-        self.memory = ReplayMemory(args)
+        input_shape = (args.num_frames, args.frame_height, args.frame_width)
+        self.history_length = args.num_frames - 1
+        self.history_processor = HistoryPreprocessor(self.history_length,
+            dtype = np.uint8 if args.uint8_input else np.float32)
+        self.atari_processor = AtariPreprocessor((args.frame_height, args.frame_width))
+        self.prioritized_replay = args.prioritized_replay
+        self.num_envs = args.num_envs
+        if self.num_envs > 1:
+            if self.prioritized_replay or args.memory_dir or args.compress_memory:
+                raise ValueError("--num_envs > 1 only supports the default replay memory")
+            # one segment per emulator, so that their frames don't interleave
+            self.memory = SegmentedReplayMemory(args, self.num_envs)
+            self.memory_writers = [self.memory.writer(i) for i in range(self.num_envs)]
+        elif self.prioritized_replay:
+            self.memory = PrioritizedReplayMemory(args)
+        else:
+            self.memory = ReplayMemory(args)
         self.policy = LinearDecayGreedyEpsilonPolicy(args.initial_epsilon, args.final_epsilon, args.exploration_steps)
+        self.random_policy = UniformRandomPolicy(num_actions)
+        self.eval_policy = GreedyEpsilonPolicy(0.05)
         self.decay_reward = args.decay_reward
         self.initial_epsilon = args.initial_epsilon
         self.final_epsilon = args.final_epsilon
@@ -156,22 +379,30 @@ class DQNAgent:
         self.num_frames_mv = args.num_frames_mv
         self.output_path = args.output
         self.save_freq = args.save_freq
+        self.memory_metrics_freq = args.memory_metrics_freq
         self.load_network = args.load_network
         self.load_network_path = args.load_network_path
         self.enable_ddqn = args.ddqn
         self.net_mode = args.net_mode
-        self.q_network = create_model(input_shape, num_actions, self.net_mode, "QNet")
-        self.target_network = create_model(input_shape, num_actions, self.net_mode, "TargetNet")
+        self.uint8_input = args.uint8_input
+        self.q_network = create_model(input_shape, num_actions, self.net_mode, "QNet", self.uint8_input)
+        self.target_network = create_model(input_shape, num_actions, self.net_mode, "TargetNet", self.uint8_input)
         print("Net mode: %s, Using double dqn: %s" % (self.net_mode, self.enable_ddqn))
         self.eval_freq = args.eval_freq
+        self.num_episodes_at_eval = args.num_episodes_at_eval
         self.no_experience = args.no_experience
         self.no_target = args.no_target
         self.mv_reward = args.mv_reward
+        self.movement_detector = MovementDetector(args.num_frames_mv)
         self.clip_reward = args.clip_reward
         self.expert_memory = None
         if args.expert_memory != None:
-            with open(args.expert_memory, 'rb') as mdump:
-                self.expert_memory = pickle.load(mdump)
+            if os.path.isdir(args.expert_memory):
+                self.expert_memory = load_memory(args.expert_memory)
+            else:
+                # pickled memory, see --convert_memory
+                with open(args.expert_memory, 'rb') as mdump:
+                    self.expert_memory = pickle.load(mdump)
         self.expert_prob = args.initial_prob_replaying_expert
         self.final_prob_replaying_expert = args.final_prob_replaying_expert
         self.decay_step_replaying_expert = (self.final_prob_replaying_expert- args.initial_prob_replaying_expert)/args.steps_replaying_expert
@@ -182,6 +413,17 @@ class DQNAgent:
         self.final_model = None
         self.compile()
 
+        # batches are built in a background thread when prefetching
+        self.prefetch_depth = args.prefetch_depth
+        self.prefetcher = None
+        self.memory_lock = threading.Lock()
+        # one batch is in use, prefetch_depth are queued and one is being built
+        shape = (self.batch_size,) + input_shape
+        dtype = np.uint8 if self.uint8_input else np.float32
+        self._batch_buffers = [(np.empty(shape, dtype = dtype), np.empty(shape, dtype = dtype))
+            for _ in range(self.prefetch_depth + 2 if self.prefetch_depth > 0 else 1)]
+        self._next_batch_buffer = 0
+
     def compile(self, optimizer = None, loss_func = None):
         """Setup all of the TF graph variables/ops.
 
@@ -200,13 +442,18 @@ class DQNAgent:
         optimizer.
         """
         if loss_func is None:
-            loss_func = mean_huber_loss
+            if self.prioritized_replay:
+                # keras only applies sample weights to per-sample losses
+                loss_func = huber_loss
+            else:
+                loss_func = mean_huber_loss
             # loss_func = 'mse'
         if optimizer is None:
             optimizer = Adam(lr = self.learning_rate)
             # optimizer = RMSprop(lr=0.00025)
         with tf.variable_scope("Loss"):
-            state = Input(shape = (self.frame_height, self.frame_width, self.num_frames) , name = "states")
+            state = Input(shape = (self.num_frames, self.frame_height, self.frame_width),
+                dtype = 'uint8' if self.uint8_input else 'float32', name = "states")
             action_mask = Input(shape = (self.num_actions,), name = "actions")
             qa_value = self.q_network(state)
             qa_value = merge([qa_value, action_mask], mode = 'mul', name = "multiply")
@@ -224,7 +471,8 @@ class DQNAgent:
         ------
         Q-values for the state(s)
         """
-        state = state[None, :, :, :]
+        if state.ndim == 3:
+            state = state[None, :, :, :]
         return self.q_network.predict_on_batch(state)
 
     def select_action(self, state, is_training = True, **kwargs):
@@ -248,15 +496,16 @@ class DQNAgent:
         --------
         selected action
         """
-        q_values = self.calc_q_values(state)
+        # only computed if the policy acts greedily
+        q_values = LazyQValues(lambda: self.calc_q_values(state)[0], (self.num_actions,))
         if is_training:
             if kwargs['policy_type'] == 'UniformRandomPolicy':
-                return UniformRandomPolicy(self.num_actions).select_action()
+                return self.random_policy.select_action()
             else:
                 # linear decay greedy epsilon policy
                 return self.policy.select_action(q_values, is_training)
         else:
-            return GreedyEpsilonPolicy(0.05).select_action(q_values)
+            return self.eval_policy.select_action(q_values)
 
     def update_policy(self, current_sample):
         """Update your policy.
@@ -283,24 +532,15 @@ class DQNAgent:
 
             action_mask = np.zeros((1, self.num_actions))
             action_mask[0, current_sample.action] = 1.0
+            weights = None
         else:
-            if self.expert_memory != None:
-                expert_samples_num = int(round(batch_size * self.expert_prob)) 
-                learner_samples_num = batch_size - expert_samples_num
-                self.expert_prob = max(self.expert_prob+self.decay_step_replaying_expert, self.final_prob_replaying_expert)
-                samples = self.memory.sample(learner_samples_num) + self.expert_memory.sample(expert_samples_num)
+            if self.prefetch_depth > 0:
+                if self.prefetcher is None:
+                    self.prefetcher = BatchPrefetcher(self._build_batch, self.prefetch_depth)
+                batch = self.prefetcher.get()
             else:
-                samples = self.memory.sample(batch_size)
-            samples = self.atari_processor.process_batch(samples)
-
-            states = np.stack([x.state for x in samples])
-            actions = np.asarray([x.action for x in samples])
-            action_mask = np.zeros((batch_size, self.num_actions))
-            action_mask[range(batch_size), actions] = 1.0
-
-            next_states = np.stack([x.next_state for x in samples])
-            mask = np.asarray([1 - int(x.is_terminal) for x in samples])
-            rewards = np.asarray([x.reward for x in samples])
+                batch = self._build_batch()
+            states, action_mask, rewards, next_states, mask, weights, learner_indexes = batch
 
         if self.no_target:
             next_qa_value = self.q_network.predict_on_batch(next_states)
@@ -315,9 +555,86 @@ class DQNAgent:
             next_qa_value = np.max(next_qa_value, axis = 1)
         target = rewards + self.gamma * mask * next_qa_value
 
-        return self.final_model.train_on_batch([states, action_mask], target), np.mean(target)
+        if weights is None:
+            loss = self.final_model.train_on_batch([states, action_mask], target)
+        else:
+            # TD errors of the network the batch was sampled with
+            td_errors = target - self.final_model.predict_on_batch([states, action_mask])[:, 0]
+            loss = self.final_model.train_on_batch([states, action_mask], target, sample_weight = weights)
+            with self.memory_lock:
+                self.memory.update_priorities(learner_indexes, td_errors[:len(learner_indexes)])
+        return loss, np.mean(target)
+
+    def _build_batch(self):
+        """Sample a minibatch and convert it to network inputs.
+
+        Runs in the prefetch thread when prefetching is enabled, so
+        the replay memory is only touched under memory_lock.
 
-    def fit(self, env, num_iterations, max_episode_length=None):
+        Returns
+        -------
+        tuple
+          (states, action_mask, rewards, next_states, mask, weights,
+          learner_indexes), where mask is 0 for terminal samples,
+          weights are the importance-sampling weights (None when the
+          memory samples uniformly) and learner_indexes are the
+          indexes of the samples drawn from self.memory.
+        """
+        batch_size = self.batch_size
+        # float buffers rotate so that prefetched batches don't share them
+        states, next_states = self._batch_buffers[self._next_batch_buffer]
+        self._next_batch_buffer = (self._next_batch_buffer + 1) % len(self._batch_buffers)
+        with self.memory_lock:
+            if self.expert_memory != None:
+                expert_samples_num = int(round(batch_size * self.expert_prob)) 
+                learner_samples_num = batch_size - expert_samples_num
+                self.expert_prob = max(self.expert_prob+self.decay_step_replaying_expert, self.final_prob_replaying_expert)
+                learner_batch = self.memory.sample_batch(learner_samples_num)
+                expert_batch = self.expert_memory.sample_batch(expert_samples_num)
+            else:
+                learner_batch = self.memory.sample_batch(batch_size)
+                expert_batch = None
+        # sample_batch buffers are only reused by the next call from this
+        # same thread, so the conversion can run outside of the lock
+        learner_samples_num = len(learner_batch)
+        self._convert_batch(learner_batch, states[:learner_samples_num], next_states[:learner_samples_num])
+        actions, rewards, terminals = learner_batch.actions, learner_batch.rewards, learner_batch.is_terminal
+        weights = learner_batch.weights
+        if expert_batch is not None:
+            self._convert_batch(expert_batch, states[learner_samples_num:], next_states[learner_samples_num:])
+            actions = np.concatenate((actions, expert_batch.actions))
+            rewards = np.concatenate((rewards, expert_batch.rewards))
+            terminals = np.concatenate((terminals, expert_batch.is_terminal))
+            if weights is not None:
+                # expert samples are drawn uniformly
+                weights = np.concatenate((weights, np.ones(len(expert_batch))))
+
+        action_mask = np.zeros((batch_size, self.num_actions))
+        action_mask[range(batch_size), actions] = 1.0
+        mask = 1 - terminals.astype(np.int64)
+        return states, action_mask, rewards, next_states, mask, weights, learner_batch.indexes
+
+    def _convert_batch(self, batch, states, next_states):
+        """Write the frames of a sampled batch into network input buffers."""
+        if self.uint8_input:
+            # the network scales the frames itself
+            np.copyto(states, batch.states)
+            np.copyto(next_states, batch.next_states)
+        else:
+            self.atari_processor.process_batch_arrays(batch.states, batch.next_states, (states, next_states))
+
+    def _process_frame(self, state, frame_id=None):
+        """Preprocess an emulator frame into the network input type.
+
+        frame_id is passed on to AtariPreprocessor.process_frame, so a
+        frame is only resized once however often it is asked for.
+        """
+        memory_frame, network_frame = self.atari_processor.process_frame(state, frame_id)
+        if self.uint8_input:
+            return memory_frame
+        return network_frame
+
+    def fit(self, env, num_iterations, max_episode_length=None, evaluator=None):
         """Fit your model to the provided environment.
 
         Its a good idea to print out things like loss, average reward,
@@ -341,15 +658,18 @@ class DQNAgent:
         max_episode_length: int
           How long a single episode should last before the agent
           resets. Can help exploration.
+        evaluator: AsyncEvaluator, optional
+          Evaluates the network in the background, closed at the end
+          of training once its last evaluation is saved. Without one
+          the evaluation runs on env and training waits for it.
         """
         is_training = True
-        sess = tf.get_default_session()
-        writer = tf.summary.FileWriter(self.output_path, sess)
-        writer.add_graph(tf.get_default_graph())
         print("Training starts.")
-        self.save_model(0)
+        writer = self._start_training()
 
         state = env.reset()
+        # identifies the current emulator frame for the preprocessing cache
+        frame_id = 0
         burn_in = True
         idx_episode = 1
         episode_loss = .0
@@ -358,42 +678,45 @@ class DQNAgent:
         episode_raw_reward = .0
         episode_no_explore_reward = .0
         episode_target_value = .0
-        burn_in_mv_rewards = []
+        # min frame differences seen during burn in, in frame value units
+        burn_in_mv_rewards = StreamingQuantile(0, 255.0 if self.uint8_input else 1.0)
         mv_threshold = -1
         burn_in_raw_reward = []
         burn_in_min_raw_reward = 99999
         mv_reward = 0
         explore_step = (self.final_epsilon - self.initial_epsilon) / self.exploration_steps
         for t in range(self.num_burn_in + num_iterations):
-            history = self.history_processor.process_state_for_network(
-                self.atari_processor.process_state_for_network(state))
-            action_state = history[:, :, -self.num_frames:]
-            mv_history = history[:, :, -self.num_frames_mv:]
+            history = self.history_processor.process_state_for_network(self._process_frame(state, frame_id))
+            action_state = history
+            if self.mv_reward:
+                self.movement_detector.append(history[-1])
             policy_type = "UniformRandomPolicy" if burn_in else "LinearDecayGreedyEpsilonPolicy"
             action = self.select_action(action_state, is_training, policy_type = policy_type)
-            processed_state = self.atari_processor.process_state_for_memory(state)
+            processed_state = self.atari_processor.process_frame(state, frame_id)[0]
 
             state, reward, done, info = env.step(action)
+            frame_id += 1
             no_explore_reward = reward
             
-            processed_next_state = self.atari_processor.process_state_for_network(state)
+            processed_next_state = self._process_frame(state, frame_id)
             if burn_in and reward > 0:
                 burn_in_min_raw_reward = min(burn_in_min_raw_reward, reward)
             if self.mv_reward:
+                min_diff = self.movement_detector.min_diff(processed_next_state)
                 if burn_in:
-                    burn_in_mv_rewards.append(np.mean(abs(mv_history-processed_next_state[:,:,np.newaxis]), axis=(0,1)))
+                    burn_in_mv_rewards.add(min_diff)
                     #burn_in_raw_reward.append(reward)
                 else:
                     if mv_threshold == -1:
-                        sorted_mv_reward_min=sorted(np.array(burn_in_mv_rewards).min(axis=1))
-                        mv_threshold = sorted_mv_reward_min[-int(len(sorted_mv_reward_min)/self.num_actions)]
-                    diff = np.mean(abs(mv_history-processed_next_state[:,:,np.newaxis]), axis=(0,1))
-                    mv_reward = 0.9 * (min(diff) > mv_threshold)
+                        mv_threshold = burn_in_mv_rewards.quantile(1 - 1.0 / self.num_actions)
+                    mv_reward = 0.9 * (min_diff > mv_threshold)
                     #min_raw_reward = min([x for x in burn_in_raw_reward if x != 0])
                     #pdb.set_trace()
 
-            action_next_state = np.dstack((action_state, processed_next_state))
-            action_next_state = action_next_state[:, :, 1:]
+            if self.no_experience:
+                action_next_state = np.concatenate((action_state[1:], processed_next_state[None]))
+            else:
+                action_next_state = None
             
             if self.decay_reward:
                 prob = self.initial_epsilon + min(t, self.exploration_steps) * explore_step
@@ -412,7 +735,8 @@ class DQNAgent:
             # else:
                 # processed_reward = 2*reward/float(burn_in_min_raw_reward) + mv_reward
 
-            self.memory.append(processed_state, action, processed_reward, done)
+            with self.memory_lock:
+                self.memory.append(processed_state, action, processed_reward, done)
             current_sample = Sample(action_state, action, processed_reward, action_next_state, done)
             
             if not burn_in: 
@@ -426,23 +750,13 @@ class DQNAgent:
             if done:
                 need_to_reset = env.lives() == 0 or episode_frames > max_episode_length
                 # adding last frame only to save last state
-                last_frame = self.atari_processor.process_state_for_memory(state)
+                last_frame = self.atari_processor.process_frame(state, frame_id)[0]
                 # action, reward, done doesn't matter here
-                self.memory.append(last_frame, action, 0, done)
+                with self.memory_lock:
+                    self.memory.append(last_frame, action, 0, done)
                 if not burn_in:
-                    avg_target_value = episode_target_value / episode_frames
-                    print("Train: time %d, episode %d, length %d, reward %.0f, raw_reward %.0f, loss %.4f, target value %.4f, policy step %d, memory cap %d"
-                        % (t, idx_episode, episode_frames, episode_reward, episode_raw_reward, episode_loss, 
-                        avg_target_value, self.policy.step, self.memory.current))
-                    sys.stdout.flush()
-                    save_scalar(idx_episode, 'episode/frames', episode_frames, writer)
-                    save_scalar(idx_episode, 'episode/reward', episode_reward, writer)
-                    save_scalar(idx_episode, 'episode/raw_reward', episode_raw_reward, writer)
-                    save_scalar(idx_episode, 'episode/no_explore_reward', episode_no_explore_reward, writer)
-                    save_scalar(idx_episode, 'episode/loss', episode_loss, writer)
-                    save_scalar(idx_episode, 'avg/reward', episode_reward / episode_frames, writer)
-                    save_scalar(idx_episode, 'avg/target_value', avg_target_value, writer)
-                    save_scalar(idx_episode, 'avg/loss', episode_loss / episode_frames, writer)
+                    self._save_episode(t, idx_episode, writer, episode_frames, episode_reward,
+                        episode_raw_reward, episode_loss, episode_target_value, episode_no_explore_reward)
                     episode_frames = 0
                     episode_reward = .0
                     episode_raw_reward = .0
@@ -453,26 +767,219 @@ class DQNAgent:
                 burn_in = (t < self.num_burn_in)
                 if need_to_reset:
                     state = env.reset()
+                    frame_id += 1
                     self.atari_processor.reset()
                     self.history_processor.reset()
+                    self.movement_detector.reset()
 
             if not burn_in:
-                if t % self.train_freq == 0:
-                    loss, target_value = self.update_policy(current_sample)
-                    episode_loss += loss
-                    episode_target_value += target_value
-                # update freq is based on train_freq
-                if t % (self.train_freq * self.target_update_freq) == 0:
-                    self.target_network.set_weights(self.q_network.get_weights())
-                if t % self.save_freq == 0:
-                    self.save_model(idx_episode)
-                if t % (self.eval_freq * self.train_freq) == 0:
-                    episode_raw_reward, episode_reward_std = self.evaluate(env, 20, max_episode_length, False)
-                    save_scalar(t, 'eval/episode_raw_reward', episode_raw_reward, writer)
-                    save_scalar(t, 'eval/episode_reward_std', episode_reward_std, writer)
+                loss, target_value = self._train_step(t, idx_episode, writer, current_sample,
+                    evaluator, env, max_episode_length)
+                episode_loss += loss
+                episode_target_value += target_value
 
-        self.save_model(idx_episode)
+        self._finish_training(idx_episode, writer, evaluator)
+
+
+    def fit_vectorized(self, env, num_iterations, max_episode_length=None, evaluator=None):
+        """Fit the model on a VecEnv, stepping its emulators in lockstep.
+
+        Same training loop as fit, but each step selects the actions
+        of all the emulators with one forward pass and stores one
+        transition per emulator, each in its own segment of the replay
+        memory. The network is updated once per train_freq transitions,
+        so num_iterations and all the frequencies count transitions.
+
+        The environments have to preprocess their frames with
+        process_state_for_memory. The movement reward and
+        --no_experience are not supported, and the network is only
+        evaluated during training when an evaluator is given.
+
+        Parameters
+        ----------
+        env: deeprl_hw2.vec_env.VecEnv
+          num_envs emulators, one per memory segment.
+        num_iterations: int
+          How many transitions to collect.
+        max_episode_length: int
+          How long a single episode should last before the agent
+          resets.
+        evaluator: AsyncEvaluator, optional
+          Evaluates the network in the background, closed at the end
+          of training once its last evaluation is saved.
+        """
+        if self.mv_reward or self.no_experience:
+            raise ValueError("fit_vectorized doesn't support --mv_reward and --no_experience")
+        num_envs = env.num_envs
+        assert num_envs == self.num_envs
+        is_training = True
+        print("Training starts with %d environments." % num_envs)
+        writer = self._start_training()
+
+        dtype = np.uint8 if self.uint8_input else np.float32
+        history_processors = [HistoryPreprocessor(self.history_length, dtype = dtype) for _ in range(num_envs)]
+        states = np.empty((num_envs, self.num_frames, self.frame_height, self.frame_width), dtype = dtype)
+        frames = env.reset()
+        burn_in = True
+        idx_episode = 1
+        episode_loss = .0
+        episode_target_value = .0
+        episode_frames = np.zeros(num_envs, dtype = np.int64)
+        episode_reward = np.zeros(num_envs)
+        episode_raw_reward = np.zeros(num_envs)
+        burn_in_min_raw_reward = 99999
+        t = 0
+        while t < self.num_burn_in + num_iterations:
+            network_frames = frames if self.uint8_input else np.divide(frames, np.float32(255.0), dtype = np.float32)
+            for i in range(num_envs):
+                history_processors[i].process_state_for_network(network_frames[i], out = states[i])
+            if burn_in:
+                actions = self.random_policy.select_action(size = num_envs)
+            else:
+                q_values = LazyQValues(lambda: self.calc_q_values(states), (num_envs, self.num_actions))
+                actions = self.policy.select_action(q_values, is_training)
+
+            next_frames, rewards, dones, lives = env.step(actions)
+
+            reset_indexes = []
+            for i in range(num_envs):
+                reward = rewards[i]
+                done = dones[i]
+                if burn_in and reward > 0:
+                    burn_in_min_raw_reward = min(burn_in_min_raw_reward, reward)
+                processed_reward = 2 * reward / float(burn_in_min_raw_reward)
+                if self.clip_reward:
+                    processed_reward = self.atari_processor.process_reward(processed_reward)
+                with self.memory_lock:
+                    self.memory_writers[i].append(frames[i], actions[i], processed_reward, done)
 
+                if not burn_in:
+                    episode_frames[i] += 1
+                    episode_reward[i] += processed_reward
+                    episode_raw_reward[i] += reward
+                    if episode_frames[i] > max_episode_length:
+                        done = True
+
+                if done:
+                    need_to_reset = lives[i] == 0 or episode_frames[i] > max_episode_length
+                    # adding last frame only to save last state
+                    with self.memory_lock:
+                        self.memory_writers[i].append(next_frames[i], actions[i], 0, done)
+                    if not burn_in:
+                        self._save_episode(t, idx_episode, writer, episode_frames[i], episode_reward[i],
+                            episode_raw_reward[i], episode_loss, episode_target_value, env_index = i)
+                        # the losses are shared by the emulators, they add up since the last episode
+                        episode_loss = .0
+                        episode_target_value = .0
+                        idx_episode += 1
+                    episode_frames[i] = 0
+                    episode_reward[i] = .0
+                    episode_raw_reward[i] = .0
+                    if need_to_reset:
+                        reset_indexes.append(i)
+                        history_processors[i].reset()
+            if reset_indexes:
+                next_frames[reset_indexes] = env.reset(reset_indexes)
+            frames = next_frames
+
+            previous_t = t
+            t += num_envs
+            burn_in = (t < self.num_burn_in)
+            if burn_in:
+                continue
+            for step in range(previous_t, t):
+                loss, target_value = self._train_step(step, idx_episode, writer, evaluator = evaluator)
+                episode_loss += loss
+                episode_target_value += target_value
+
+        self._finish_training(idx_episode, writer, evaluator)
+
+    def _start_training(self):
+        """Open the tensorboard writer and save the initial network."""
+        sess = tf.get_default_session()
+        writer = tf.summary.FileWriter(self.output_path, sess)
+        writer.add_graph(tf.get_default_graph())
+        self.save_model(0)
+        return writer
+
+    def _train_step(self, t, idx_episode, writer, current_sample=None, evaluator=None, env=None,
+                    max_episode_length=None):
+        """Do the periodic work of training step t, after burn in.
+
+        Updates the network every train_freq steps, and at their own
+        frequencies the target network, the saved model, the memory
+        metrics and the evaluations. Without an evaluator the network
+        is evaluated on env, if given, and training waits for it.
+
+        Returns
+        -------
+        tuple(float)
+          (loss, target_value) of the update, zeros without one.
+        """
+        loss = target_value = .0
+        if t % self.train_freq == 0:
+            loss, target_value = self.update_policy(current_sample)
+        # update freq is based on train_freq
+        if t % (self.train_freq * self.target_update_freq) == 0:
+            self.target_network.set_weights(self.q_network.get_weights())
+        if t % self.save_freq == 0:
+            self.save_model(idx_episode)
+        if self.memory_metrics_freq > 0 and t % self.memory_metrics_freq == 0:
+            with self.memory_lock:
+                memory_metrics = self.memory.metrics()
+            for name, value in memory_metrics.items():
+                save_scalar(t, 'memory/' + name, value, writer)
+        if t % (self.eval_freq * self.train_freq) == 0:
+            if evaluator is not None:
+                evaluator.submit(t, self.q_network)
+            elif env is not None:
+                reward_mean, reward_std = self.evaluate(env, self.num_episodes_at_eval, max_episode_length, False)
+                save_scalar(t, 'eval/episode_raw_reward', reward_mean, writer)
+                save_scalar(t, 'eval/episode_reward_std', reward_std, writer)
+        if evaluator is not None and t % self.train_freq == 0:
+            self._save_evaluations(evaluator.poll(), writer)
+        return loss, target_value
+
+    def _save_episode(self, t, idx_episode, writer, frames, reward, raw_reward, loss, target_value,
+                      no_explore_reward=None, env_index=None):
+        """Print the stats of a finished episode and write them to tensorboard.
+
+        loss and target_value are the sums over the updates done
+        during the episode.
+        """
+        env = "" if env_index is None else ", env %d" % env_index
+        avg_target_value = target_value / frames
+        print("Train: time %d%s, episode %d, length %d, reward %.0f, raw_reward %.0f, loss %.4f, target value %.4f, policy step %d, memory cap %d"
+            % (t, env, idx_episode, frames, reward, raw_reward, loss,
+            avg_target_value, self.policy.step, self.memory.current))
+        sys.stdout.flush()
+        save_scalar(idx_episode, 'episode/frames', frames, writer)
+        save_scalar(idx_episode, 'episode/reward', reward, writer)
+        save_scalar(idx_episode, 'episode/raw_reward', raw_reward, writer)
+        if no_explore_reward is not None:
+            save_scalar(idx_episode, 'episode/no_explore_reward', no_explore_reward, writer)
+        save_scalar(idx_episode, 'episode/loss', loss, writer)
+        save_scalar(idx_episode, 'avg/reward', reward / frames, writer)
+        save_scalar(idx_episode, 'avg/target_value', avg_target_value, writer)
+        save_scalar(idx_episode, 'avg/loss', loss / frames, writer)
+
+    def _finish_training(self, idx_episode, writer, evaluator=None):
+        """Save the network, flush the memory and save the last evaluations."""
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+        self.save_model(idx_episode)
+        with self.memory_lock:
+            self.memory.flush()
+        if evaluator is not None:
+            self._save_evaluations(evaluator.close(), writer)
+
+    def _save_evaluations(self, evaluations, writer):
+        """Write the (t, reward_mean, reward_std) evaluations to tensorboard."""
+        for t, reward_mean, reward_std in evaluations:
+            print("Evaluation at time %d: reward_mean [%.3f], reward_std [%.3f]" % (t, reward_mean, reward_std))
+            save_scalar(t, 'eval/episode_raw_reward', reward_mean, writer)
+            save_scalar(t, 'eval/episode_reward_std', reward_std, writer)
 
     def save_model(self, idx_episode):
         safe_path = self.output_path + "/qnet" + str(idx_episode) + ".h5"
@@ -491,47 +998,14 @@ class DQNAgent:
 
         You can also call the render function here if you want to
         visually inspect your policy.
-        """
-        print("Evaluation starts.")
 
-        is_training = False
+        The episodes are played by evaluate_policy, with their own
+        preprocessors, so the training histories are left untouched.
+        """
         if self.load_network:
             self.q_network.load_weights(self.load_network_path)
             print("Load network from:", self.load_network_path)
         if monitor:
             env = wrappers.Monitor(env, self.output_path, video_callable=lambda x:True)
-        state = env.reset()
-
-        idx_episode = 1
-        episode_frames = 0
-        episode_reward = np.zeros(num_episodes)
-        t = 0
-
-        while idx_episode <= num_episodes:
-            t += 1
-            history = self.history_processor.process_state_for_network(
-                self.atari_processor.process_state_for_network(state))
-            action_state = history[:, :, -self.num_frames:]
-            action = self.select_action(action_state, is_training, policy_type = 'GreedyEpsilonPolicy')
-            state, reward, done, info = env.step(action)
-            episode_frames += 1
-            episode_reward[idx_episode-1] += reward 
-            if episode_frames > max_episode_length:
-                done = True
-            if done:
-                print("Eval: time %d, episode %d, length %d, reward %.0f" %
-                    (t, idx_episode, episode_frames, episode_reward[idx_episode-1]))
-                sys.stdout.flush()
-                state = env.reset()
-                episode_frames = 0
-                idx_episode += 1
-                self.atari_processor.reset()
-                self.history_processor.reset()
-
-        reward_mean = np.mean(episode_reward)
-        reward_std = np.std(episode_reward)
-        print("Evaluation summury: num_episodes [%d], reward_mean [%.3f], reward_std [%.3f]" %
-            (num_episodes, reward_mean, reward_std))
-        sys.stdout.flush()
-
-        return reward_mean, reward_std
+        return evaluate_policy(env, self.calc_q_values, self.num_actions, num_episodes, max_episode_length,
+            self.num_frames, (self.frame_height, self.frame_width), self.uint8_input, self.eval_policy)
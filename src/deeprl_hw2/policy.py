@@ -33,6 +33,40 @@ class Policy:
         """
         raise NotImplementedError('This method should be overriden.')
 
+class LazyQValues(object):
+    """Q-values that are only computed when a policy needs them.
+
+    Policies only look at the shape of their Q-values until they pick
+    a greedy action, so when they explore the forward pass is never
+    run. np.asarray(lazy_q_values) computes the values, once.
+
+    Parameters
+    ----------
+    compute: callable
+      Called without arguments, returns the Q-values.
+    shape: tuple
+      Shape of the Q-values, (num_actions,) or (N, num_actions).
+    """
+
+    def __init__(self, compute, shape):
+        self.compute = compute
+        self.shape = tuple(shape)
+        self.values = None
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        if self.values is None:
+            self.values = np.asarray(self.compute())
+        if dtype is not None:
+            return self.values.astype(dtype)
+        return self.values
+
 class UniformRandomPolicy(Policy):
     """Chooses a discrete action with uniform random probability.
 
@@ -42,6 +76,8 @@ class UniformRandomPolicy(Policy):
     ----------
     num_actions: int
       Number of actions to choose from. Must be > 0.
+    rng: np.random.RandomState, optional
+      Random generator, the global numpy one by default.
 
     Raises
     ------
@@ -49,21 +85,33 @@ class UniformRandomPolicy(Policy):
       If num_actions <= 0
     """
 
-    def __init__(self, num_actions):
+    def __init__(self, num_actions, rng=None):
         assert num_actions >= 1
         self.num_actions = num_actions
+        self.rng = np.random if rng is None else rng
 
-    def select_action(self, **kwargs):
+    def select_action(self, q_values=None, size=None, **kwargs):
         """Return a random action index.
 
         This policy cannot contain others (as they would just be ignored).
 
+        Parameters
+        ----------
+        q_values: np.array, LazyQValues, optional
+          Only used for its shape: with (N, num_actions) Q-values, N
+          actions are returned.
+        size: int, optional
+          Number of actions to return.
+
         Returns
         -------
-        int:
-          Action index in range [0, num_actions)
+        int or np.array:
+          Action index in range [0, num_actions), or an array of them
+          when several are asked for.
         """
-        return np.random.randint(0, self.num_actions)
+        if size is None and q_values is not None and np.ndim(q_values) == 2:
+            size = len(q_values)
+        return self.rng.randint(0, self.num_actions, size = size)
 
     def get_config(self):  # noqa: D102
         return {'num_actions': self.num_actions}
@@ -71,11 +119,12 @@ class UniformRandomPolicy(Policy):
 class GreedyPolicy(Policy):
     """Always returns best action according to Q-values.
 
-    This is a pure exploitation policy.
+    This is a pure exploitation policy. Q-values of shape
+    (num_actions,) give one action, (N, num_actions) an array of N.
     """
 
     def select_action(self, q_values, **kwargs):  # noqa: D102
-        return np.argmax(q_values)
+        return np.argmax(np.asarray(q_values), axis = -1)
 
 class GreedyEpsilonPolicy(Policy):
     """Selects greedy action or with some probability a random action.
@@ -85,38 +134,55 @@ class GreedyEpsilonPolicy(Policy):
 
     Parameters
     ----------
-    epsilon: float
+    epsilon: float, np.array
      Initial probability of choosing a random action. Can be changed
-     over time.
+     over time. An array gives each row of Q-values its own epsilon.
+    rng: np.random.RandomState, optional
+      Random generator, the global numpy one by default.
     """
-    def __init__(self, epsilon):
+    def __init__(self, epsilon, rng=None):
         self.epsilon = epsilon
+        self.rng = np.random if rng is None else rng
 
-    def select_action(self, q_values, **kwargs):
+    def select_action(self, q_values, epsilon=None, **kwargs):
         """Run Greedy-Epsilon for the given Q-values.
 
         Parameters
         ----------
-        q_values: array-like
-          Array-like structure of floats representing the Q-values for
-          each action.
+        q_values: array-like, LazyQValues
+          Q-values of shape (num_actions,) or (N, num_actions). Lazy
+          Q-values are not computed when every row explores.
+        epsilon: float, np.array, optional
+          Overrides self.epsilon, one value or one per row.
 
         Returns
         -------
-        int:
-          The action index chosen.
+        int or np.array:
+          The action index chosen, an array of N of them for
+          (N, num_actions) Q-values.
         """
-        num_actions = q_values.shape[1] 
-        if np.random.rand() < self.epsilon:
-            return UniformRandomPolicy(num_actions).select_action()
+        if epsilon is None:
+            epsilon = self.epsilon
+        shape = np.shape(q_values)
+        num_rows = shape[0] if len(shape) == 2 else 1
+        explore = self.rng.random_sample(num_rows) < epsilon
+        num_explore = np.count_nonzero(explore)
+        if num_explore < num_rows:
+            actions = np.argmax(np.asarray(q_values).reshape(num_rows, -1), axis = 1)
         else:
-            return GreedyPolicy().select_action(q_values)
+            actions = np.empty(num_rows, dtype = np.int64)
+        if num_explore > 0:
+            actions[explore] = self.rng.randint(0, shape[-1], size = num_explore)
+        if len(shape) == 1:
+            return actions[0]
+        return actions
 
 class LinearDecayGreedyEpsilonPolicy(Policy):
     """Policy with a parameter that decays linearly.
 
     Like GreedyEpsilonPolicy but the epsilon decays from a start value
-    to an end value over k steps.
+    to an end value over k steps. Each row of Q-values counts as one
+    step, so the rows of a batch get successive epsilons.
 
     Parameters
     ----------
@@ -126,36 +192,44 @@ class LinearDecayGreedyEpsilonPolicy(Policy):
       The value of the policy at the end of the decay.
     num_steps: int
       The number of steps over which to decay the value.
+    rng: np.random.RandomState, optional
+      Random generator, the global numpy one by default.
 
     """
 
-    def __init__(self, start_value, end_value, num_steps):  # noqa: D102
+    def __init__(self, start_value, end_value, num_steps, rng=None):  # noqa: D102
         self.start_value = start_value
         self.decay_rate = float(end_value - start_value) / num_steps
         self.end_value = end_value
         self.step = 0
+        self.greedy_epsilon = GreedyEpsilonPolicy(start_value, rng)
 
     def select_action(self, q_values, is_training = True, **kwargs):
         """Decay parameter and select action.
 
         Parameters
         ----------
-        q_values: np.array
-          The Q-values for each action.
+        q_values: np.array, LazyQValues
+          The Q-values for each action, (num_actions,) or
+          (N, num_actions).
         is_training: bool, optional
           If true then parameter will be decayed. Defaults to true.
 
         Returns
         -------
         Any:
-          Selected action.
+          Selected action, or array of N actions.
         """
-        epsilon = self.start_value
-        if is_training:
-            epsilon += self.decay_rate * self.step
-            self.step += 1
-        epsilon = max(epsilon, self.end_value)
-        return GreedyEpsilonPolicy(epsilon).select_action(q_values)
+        if not is_training:
+            return self.greedy_epsilon.select_action(q_values, max(self.start_value, self.end_value))
+        num_rows = len(q_values) if np.ndim(q_values) == 2 else 1
+        if num_rows == 1:
+            epsilon = self.start_value + self.decay_rate * self.step
+        else:
+            epsilon = self.start_value + self.decay_rate * np.arange(self.step, self.step + num_rows)
+        self.step += num_rows
+        epsilon = np.maximum(epsilon, self.end_value)
+        return self.greedy_epsilon.select_action(q_values, epsilon)
 
     def reset(self):
         """Start the decay over at the start value."""
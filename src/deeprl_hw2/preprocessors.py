@@ -1,7 +1,6 @@
 """Suggested Preprocessors."""
 
 import numpy as np
-from PIL import Image
 
 from deeprl_hw2 import utils
 from deeprl_hw2.core import Preprocessor
@@ -16,35 +15,164 @@ class HistoryPreprocessor(Preprocessor):
     When the environment starts, this will just fill the initial
     sequence values with zeros k times.
 
+    The frames are kept in a ring buffer with room for twice the
+    history, and every frame is written to both halves. The last k+1
+    frames are then always a single slice of the buffer, so the
+    history is returned as a view and stepping allocates nothing.
+
     Parameters
     ----------
     history_length: int
       Number of previous states to prepend to state being processed.
+    dtype: np.dtype, optional
+      Type of the stored frames. Defaults to the type of the first
+      state, e.g. uint8 or float32 frames.
 
     """
 
-    def __init__(self, history_length=1):
+    def __init__(self, history_length=1, dtype=None):
         self.history_length = history_length
-        self.past_states = None 
+        self.dtype = dtype
+        self.frames = None
+        self.index = 0
 
-    def process_state_for_network(self, state):
-        """You only want history when you're deciding the current action to take."""
-        row, col = state.shape
-        if self.past_states is None:
-            self.past_states = np.zeros((row, col, self.history_length))
-        history = np.dstack((self.past_states, state))
-        self.past_states = history[:, :, 1:]
-        return history
+    def process_state_for_network(self, state, out=None):
+        """You only want history when you're deciding the current action to take.
+
+        Parameters
+        ----------
+        state: np.ndarray
+          The newest frame, of shape (rows, cols).
+        out: np.ndarray, optional
+          Array of shape (history_length + 1, rows, cols) to copy the
+          history into.
+
+        Returns
+        -------
+        np.ndarray
+          The last history_length + 1 frames, oldest first. Unless out
+          is given this is a view into the ring buffer, valid until
+          the next call.
+        """
+        num_frames = self.history_length + 1
+        if self.frames is None:
+            row, col = state.shape
+            dtype = state.dtype if self.dtype is None else self.dtype
+            self.frames = np.zeros((2 * num_frames, row, col), dtype = dtype)
+        self.frames[self.index] = state
+        self.frames[self.index + num_frames] = state
+        self.index = (self.index + 1) % num_frames
+        history = self.frames[self.index:self.index + num_frames]
+        if out is None:
+            return history
+        np.copyto(out, history)
+        return out
 
     def reset(self):
         """Reset the history sequence.
 
         Useful when you start a new episode.
         """
-        self.past_states = None
+        if self.frames is not None:
+            self.frames.fill(0)
+        self.index = 0
+
+    def get_config(self):
+        return {'history_length': self.history_length, 'dtype': self.dtype}
+
+class MovementDetector(Preprocessor):
+    """Measures how much a new frame differs from the recent ones.
+
+    Keeps the last num_frames frames (zeros after a reset, like
+    HistoryPreprocessor) as one contiguous float32 array, so the
+    difference of a new frame with all of them is a few in-place
+    ufuncs over preallocated buffers.
+
+    Parameters
+    ----------
+    num_frames: int
+      Number of past frames the new frame is compared with.
+    """
+
+    def __init__(self, num_frames):
+        self.num_frames = num_frames
+        self.frames = None
+        self.diffs = None
+        self.index = 0
+
+    def append(self, state):
+        """Add a frame, replacing the oldest one."""
+        if self.frames is None:
+            self.frames = np.zeros((self.num_frames,) + state.shape, dtype = np.float32)
+            self.diffs = np.empty_like(self.frames)
+        np.copyto(self.frames[self.index], state)
+        self.index = (self.index + 1) % self.num_frames
+
+    def min_diff(self, state):
+        """Mean absolute difference of state with the closest past frame.
+
+        The difference with each past frame is made against the new
+        frame, so none of them can be carried over from the previous
+        step: each pair of frames is still only compared once.
+        """
+        np.subtract(self.frames, state, out = self.diffs)
+        np.abs(self.diffs, out = self.diffs)
+        return self.diffs.reshape(self.num_frames, -1).mean(axis = 1).min()
+
+    def reset(self):
+        if self.frames is not None:
+            self.frames.fill(0)
+        self.index = 0
 
     def get_config(self):
-        return {'history_length': self.history_length}
+        return {'num_frames': self.num_frames}
+
+def _resample_matrix(in_size, out_size):
+    """Build the bilinear resampling operator of one image axis.
+
+    The weights are computed the way PIL computes them for
+    Image.BILINEAR: a triangle filter whose support grows with the
+    downscaling factor, so every input pixel contributes to the
+    output (antialiasing) instead of only the two nearest ones.
+
+    Returns
+    -------
+    np.ndarray
+      float32 array of shape (out_size, in_size) whose rows sum to 1.
+    """
+    scale = in_size / float(out_size)
+    filterscale = max(scale, 1.0)
+    centers = (np.arange(out_size) + 0.5) * scale
+    xmin = np.maximum((centers - filterscale + 0.5).astype(int), 0)
+    xmax = np.minimum((centers + filterscale + 0.5).astype(int), in_size)
+    x = np.arange(in_size)
+    weights = np.maximum(1.0 - np.abs((x - centers[:, np.newaxis] + 0.5) / filterscale), 0.0)
+    weights[(x < xmin[:, np.newaxis]) | (x >= xmax[:, np.newaxis])] = 0.0
+    weights /= weights.sum(axis=1, keepdims=True)
+    return weights.astype(np.float32)
+
+def _split_operator(operator, block_size=16):
+    """Split a banded (in_size, out_size) operator into dense blocks.
+
+    Each block of block_size outputs only depends on a short range of
+    inputs, so applying the blocks one by one skips the multiplications
+    by zero a full matrix product would do.
+
+    Returns
+    -------
+    list(tuple)
+      (in_start, in_stop, out_start, out_stop, weights) tuples, weights
+      being the contiguous (in_stop - in_start, out_stop - out_start)
+      block of the operator.
+    """
+    blocks = []
+    for out_start in range(0, operator.shape[1], block_size):
+        out_stop = min(out_start + block_size, operator.shape[1])
+        inputs = np.flatnonzero(operator[:, out_start:out_stop].any(axis=1))
+        in_start, in_stop = inputs[0], inputs[-1] + 1
+        weights = np.ascontiguousarray(operator[in_start:in_stop, out_start:out_stop])
+        blocks.append((in_start, in_stop, out_start, out_stop, weights))
+    return blocks
 
 class AtariPreprocessor(Preprocessor):
     """Converts images to greyscale and downscales.
@@ -82,6 +210,62 @@ class AtariPreprocessor(Preprocessor):
       (84, 84) will make each image in the output have shape (84, 84).
     """
 
+    # ITU-R 601-2 luma transform, the same one PIL uses for convert('L')
+    luminance = np.array([0.299, 0.587, 0.114], dtype = np.float32)
+
+    def __init__(self, new_size=(84, 84)):
+        self.new_size = tuple(new_size)
+        self.cached_frame_id = None
+        self.cached_frame = None
+        self.operators = {}
+
+    def _get_operators(self, frame_shape):
+        """Return the resampling operators for frames of frame_shape.
+
+        Resizing is done as rows_op @ frame @ cols_op, each operator
+        split into blocks by _split_operator. For RGB frames cols_op
+        also does the greyscale conversion: it is applied to the frame
+        viewed as (rows, cols * 3), so one matrix product both mixes
+        the channels and resizes the columns. The operators, and the
+        float32 buffers the products are written to, only depend on
+        the frame shape and are built once.
+        """
+        operators = self.operators.get(frame_shape)
+        if operators is None:
+            rows, cols = frame_shape[:2]
+            rows_op = _resample_matrix(rows, self.new_size[0]).T
+            cols_op = _resample_matrix(cols, self.new_size[1]).T
+            if len(frame_shape) == 3:
+                # single channel screens are already grey, a 4th (alpha) channel is ignored
+                luminance = np.zeros(frame_shape[2], dtype = np.float32)
+                if frame_shape[2] == 1:
+                    luminance[0] = 1.0
+                else:
+                    luminance[:3] = self.luminance
+                cols_op = (cols_op[:, np.newaxis, :] * luminance[:, np.newaxis])
+                cols_op = cols_op.reshape(cols * frame_shape[2], self.new_size[1])
+            rows_blocks = [(start, stop, out_start, out_stop, np.ascontiguousarray(weights.T))
+                for start, stop, out_start, out_stop, weights in _split_operator(rows_op)]
+            buffers = (np.empty((rows, cols_op.shape[0]), dtype = np.float32),
+                np.empty((rows, self.new_size[1]), dtype = np.float32),
+                np.empty(self.new_size, dtype = np.float32))
+            operators = (rows_blocks, _split_operator(cols_op), buffers)
+            self.operators[frame_shape] = operators
+        return operators
+
+    def _resize(self, state, out):
+        """Greyscale and resize one state into the uint8 array out."""
+        rows_blocks, cols_blocks, (frame, columns, resized) = self._get_operators(state.shape)
+        np.copyto(frame, state.reshape(frame.shape))
+        for start, stop, out_start, out_stop, weights in cols_blocks:
+            np.matmul(frame[:, start:stop], weights, out = columns[:, out_start:out_stop])
+        for start, stop, out_start, out_stop, weights in rows_blocks:
+            np.matmul(weights, columns[start:stop], out = resized[out_start:out_stop])
+        # round half up like PIL, the weights are positive so no clipping is needed
+        resized += 0.5
+        np.copyto(out, resized, casting = 'unsafe')
+        return out
+
     def process_state_for_memory(self, state):
         """Scale, convert to greyscale and store as uint8.
 
@@ -89,12 +273,39 @@ class AtariPreprocessor(Preprocessor):
         memory. We get the same resolution as uint8, but use a quarter
         to an eigth of the bytes (depending on float32 or float64)
 
-        We recommend using the Python Image Library (PIL) to do the
-        image conversions.
+        The conversion is two banded matrix products with precomputed
+        operators, see _get_operators. It matches PIL's
+        convert('L').resize(new_size, Image.BILINEAR) to within one
+        grey level. Greyscale (rows, cols) or (rows, cols, 1) states
+        are only resized.
+        """
+        return self._resize(state, np.empty(self.new_size, dtype = np.uint8))
+
+    def process_batch_for_memory(self, states, out=None):
+        """Same as process_state_for_memory on a stack of states.
+
+        The states are processed one at a time: the per-state products
+        stay in cache, which is faster than one product over the whole
+        stack.
+
+        Parameters
+        ----------
+        states: np.ndarray
+          Array of shape (num_states, rows, cols, 3) or
+          (num_states, rows, cols).
+        out: np.ndarray, optional
+          uint8 array of shape (num_states,) + new_size to write into.
+
+        Returns
+        -------
+        np.ndarray
+          uint8 array of shape (num_states,) + new_size.
         """
-        img = Image.fromarray(state).convert('L').resize((84, 84), Image.BILINEAR)
-        state = np.array(img)
-        return state
+        if out is None:
+            out = np.empty((len(states),) + self.new_size, dtype = np.uint8)
+        for i in range(len(states)):
+            self._resize(states[i], out[i])
+        return out
 
     def process_state_for_network(self, state):
         """Scale, convert to greyscale and store as float32.
@@ -104,6 +315,30 @@ class AtariPreprocessor(Preprocessor):
         """
         return np.float32(self.process_state_for_memory(state) / 255.0)
 
+    def process_frame(self, state, frame_id=None):
+        """Return the uint8 and float32 versions of a frame at once.
+
+        The frame is converted and resized only once for both
+        versions. The result of the last call is cached under
+        frame_id, so asking again for the same frame (e.g. for the
+        network and then for the replay memory) costs nothing. Pass a
+        new frame_id for every new frame, or None to skip the cache.
+
+        Returns
+        -------
+        tuple(np.ndarray, np.ndarray)
+          The frame as process_state_for_memory and as
+          process_state_for_network would return it.
+        """
+        if frame_id is not None and frame_id == self.cached_frame_id:
+            return self.cached_frame
+        memory_frame = self.process_state_for_memory(state)
+        frame = (memory_frame, np.divide(memory_frame, np.float32(255.0), dtype = np.float32))
+        if frame_id is not None:
+            self.cached_frame_id = frame_id
+            self.cached_frame = frame
+        return frame
+
     def process_batch(self, samples):
         """The batches from replay memory will be uint8, convert to float32.
 
@@ -117,6 +352,41 @@ class AtariPreprocessor(Preprocessor):
             samples[i].next_state = np.float32(samples[i].next_state / 255.0)
         return samples
 
+    def process_batch_arrays(self, states, next_states, out=None):
+        """Convert stacked uint8 states and next states to float32.
+
+        Batch-level version of process_batch for the arrays returned
+        by ReplayMemory.sample_batch. Each array is scaled by a single
+        float32 ufunc call straight into the output buffers, with no
+        temporaries.
+
+        Parameters
+        ----------
+        states: np.ndarray
+          uint8 array of shape (batch_size, channels, rows, cols).
+        next_states: np.ndarray
+          uint8 array of the same shape.
+        out: tuple(np.ndarray, np.ndarray), optional
+          float32 arrays of the same shape to write into. By default
+          buffers owned by the preprocessor are reused, so the result
+          is only valid until the next call.
+
+        Returns
+        -------
+        tuple(np.ndarray, np.ndarray)
+          The float32 states and next states.
+        """
+        if out is None:
+            buffers = getattr(self, '_batch_buffers', None)
+            if buffers is None or buffers[0].shape != states.shape:
+                buffers = (np.empty(states.shape, dtype = np.float32),
+                    np.empty(next_states.shape, dtype = np.float32))
+                self._batch_buffers = buffers
+            out = buffers
+        np.divide(states, np.float32(255.0), out = out[0])
+        np.divide(next_states, np.float32(255.0), out = out[1])
+        return out
+
     def process_reward(self, reward):
         """Clip reward between -1 and 1."""
         return np.sign(reward) 
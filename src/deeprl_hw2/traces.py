@@ -0,0 +1,375 @@
+"""Writing and reading recorded expert traces."""
+
+import pickle
+import struct
+
+import numpy as np
+
+from deeprl_hw2.preprocessors import AtariPreprocessor
+
+
+TRACE_MAGIC = b'DQNTRACE'
+TRACE_VERSION = 1
+# magic, version, chunk_size, ndim, frame shape (up to 3 dimensions)
+_HEADER = struct.Struct('<8sIII3I')
+_HEADER_SIZE = 64
+# number of chunks, number of rows, magic
+_FOOTER = struct.Struct('<QQ8s')
+_FOOTER_MAGIC = b'TRACEIDX'
+
+
+def _aligned(size):
+    return (size + 7) // 8 * 8
+
+
+def _chunk_layout(chunk_size, frame_shape):
+    """Byte offsets of the columns in a chunk, and the chunk size.
+
+    A chunk is the number of rows it holds (uint64) followed by the
+    rewards (float64), actions (int32), done flags (uint8) and frames
+    (uint8) of chunk_size rows, each column aligned on 8 bytes.
+    """
+    frame_bytes = int(np.prod(frame_shape))
+    offsets = {}
+    offset = 8
+    for name, itemsize in (('rewards', 8), ('actions', 4), ('dones', 1), ('frames', frame_bytes)):
+        offsets[name] = offset
+        offset += _aligned(chunk_size * itemsize)
+    return offsets, offset
+
+
+def _chunk_views(buf, chunk_size, frame_shape, offsets, count=None):
+    """Column arrays over the bytes of one chunk."""
+    if count is None:
+        count = chunk_size
+    frame_bytes = int(np.prod(frame_shape))
+    def column(name, dtype, itemsize):
+        start = offsets[name]
+        return buf[start:start + count * itemsize].view(dtype)
+    return (column('frames', np.uint8, frame_bytes).reshape((count,) + tuple(frame_shape)),
+        column('actions', np.int32, 4), column('rewards', np.float64, 8),
+        column('dones', np.bool_, 1))
+
+
+class TraceWriter(object):
+    """Writes a trace in the chunked binary format, append only.
+
+    The trace is a header followed by fixed-size chunks of chunk_size
+    rows, each holding a uint8 frame block and the action, reward and
+    done columns, and ends with an index of the number of rows of each
+    chunk. A row is (state, action, reward, done), state being the
+    frame seen before taking action, as yielded by iter_trace.
+
+    Only the chunk being filled is kept in memory, frames are copied
+    straight into it. A chunk is written once full, so a trace cut
+    short (e.g. by a crash) still has its complete chunks, which
+    TraceReader finds without the index.
+
+    Rows are built one step at a time with write_state, write_step and
+    write_gap, like the episodes are played, or appended whole with
+    append.
+
+    Parameters
+    ----------
+    path: str
+      Path of the trace file.
+    frame_shape: tuple(int)
+      Shape of the frames, e.g. (rows, cols, 3).
+    chunk_size: int
+      Number of rows per chunk.
+    """
+    def __init__(self, path, frame_shape, chunk_size=64):
+        if len(frame_shape) > 3:
+            raise ValueError("Frames have at most 3 dimensions, got shape %s" % (frame_shape,))
+        self.frame_shape = tuple(frame_shape)
+        self.chunk_size = chunk_size
+        self.offsets, self.chunk_bytes = _chunk_layout(chunk_size, self.frame_shape)
+        self.chunk = np.zeros(self.chunk_bytes, dtype = np.uint8)
+        self.frames, self.actions, self.rewards, self.dones = _chunk_views(self.chunk,
+            chunk_size, self.frame_shape, self.offsets)
+        self.count = 0
+        self.chunk_counts = []
+        # the current row has its frame but not its action yet
+        self.pending = False
+        self.last_action = None
+        self.file = open(path, 'wb')
+        shape = self.frame_shape + (0,) * (3 - len(self.frame_shape))
+        header = _HEADER.pack(TRACE_MAGIC, TRACE_VERSION, chunk_size, len(self.frame_shape), *shape)
+        self.file.write(header.ljust(_HEADER_SIZE, b'\0'))
+
+    def _flush(self):
+        if self.count == 0:
+            return
+        self.chunk[:8].view(np.uint64)[0] = self.count
+        self.file.write(self.chunk.data)
+        self.chunk_counts.append(self.count)
+        self.count = 0
+
+    def _end_row(self, action, reward, done):
+        self.actions[self.count] = action
+        self.rewards[self.count] = reward
+        self.dones[self.count] = done
+        self.count += 1
+        self.pending = False
+        if self.count == self.chunk_size:
+            self._flush()
+
+    def append(self, state, action, reward, done):
+        """Append a whole row."""
+        self.write_state(state)
+        self._end_row(action, reward, done)
+
+    def write_state(self, state):
+        """Write the first state of the episode."""
+        self.frames[self.count] = state
+        self.pending = True
+
+    def write_step(self, action, reward, done, next_state):
+        """Complete the current row and start the next one."""
+        if self.pending:
+            self._end_row(action, reward, done)
+        self.last_action = action
+        self.write_state(next_state)
+
+    def write_gap(self):
+        """Mark that steps are missing before the next one.
+
+        The row before the gap ends like an episode, so that no state
+        history spans it.
+        """
+        if self.pending and self.last_action is not None:
+            self._end_row(self.last_action, 0, True)
+        self.pending = False
+
+    def close(self):
+        """Write the last state, the partial chunk and the index.
+
+        The last state ends the trace like an episode end, even when
+        the episode was cut short, so that traces merged back to back
+        don't share state histories.
+        """
+        if self.pending and self.last_action is not None:
+            # the last frame of an episode, stored like the agent does
+            self._end_row(self.last_action, 0, True)
+        self._flush()
+        counts = np.array(self.chunk_counts, dtype = np.uint32)
+        self.file.write(counts.tobytes().ljust(_aligned(counts.nbytes), b'\0'))
+        self.file.write(_FOOTER.pack(len(counts), int(counts.sum()), _FOOTER_MAGIC))
+        self.file.close()
+
+
+class TraceReader(object):
+    """Reads a trace written by TraceWriter.
+
+    The file is memory mapped: frames are only read from disk when
+    accessed, so traces bigger than RAM can be read at random with
+    reader[i] or read(start, stop), or streamed chunk by chunk with
+    iter_chunks. Reading the columns only, read(frames=False), doesn't
+    touch the frames at all.
+
+    A trace that wasn't closed has no index, its complete chunks are
+    read.
+
+    Parameters
+    ----------
+    path: str
+      Path of the trace file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = np.memmap(path, dtype = np.uint8, mode = 'r')
+        magic, version, chunk_size, ndim, *shape = _HEADER.unpack_from(self.data, 0)
+        if magic != TRACE_MAGIC:
+            raise ValueError("%s is not a binary trace" % path)
+        if version != TRACE_VERSION:
+            raise ValueError("Unsupported trace version %d in %s" % (version, path))
+        self.chunk_size = chunk_size
+        self.frame_shape = tuple(shape[:ndim])
+        self.offsets, self.chunk_bytes = _chunk_layout(chunk_size, self.frame_shape)
+        self.chunk_counts = self._read_index()
+        # index of the first row of each chunk, plus the number of rows
+        self.chunk_starts = np.concatenate(([0], np.cumsum(self.chunk_counts)))
+
+    def _read_index(self):
+        size = len(self.data)
+        if size >= _HEADER_SIZE + _FOOTER.size:
+            num_chunks, num_rows, magic = _FOOTER.unpack_from(self.data, size - _FOOTER.size)
+            index_bytes = _aligned(4 * num_chunks)
+            if (magic == _FOOTER_MAGIC and size == _HEADER_SIZE + num_chunks * self.chunk_bytes
+                    + index_bytes + _FOOTER.size):
+                start = size - _FOOTER.size - index_bytes
+                return self.data[start:start + 4 * num_chunks].view(np.uint32).astype(np.int64)
+        # not closed, scan the complete chunks
+        num_chunks = (size - _HEADER_SIZE) // self.chunk_bytes
+        return np.array([self._chunk_bytes(i)[:8].view(np.uint64)[0] for i in range(num_chunks)],
+            dtype = np.int64)
+
+    def _chunk_bytes(self, i):
+        start = _HEADER_SIZE + i * self.chunk_bytes
+        return self.data[start:start + self.chunk_bytes]
+
+    def __len__(self):
+        return int(self.chunk_starts[-1])
+
+    @property
+    def num_chunks(self):
+        return len(self.chunk_counts)
+
+    def chunk(self, i):
+        """Views on the rows of chunk i.
+
+        Returns
+        -------
+        tuple(np.ndarray)
+          (frames, actions, rewards, dones), read only.
+        """
+        return _chunk_views(self._chunk_bytes(i), self.chunk_size, self.frame_shape,
+            self.offsets, int(self.chunk_counts[i]))
+
+    def iter_chunks(self):
+        """Yield the (frames, actions, rewards, dones) of each chunk."""
+        for i in range(self.num_chunks):
+            yield self.chunk(i)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("Row %d out of range for a trace of %d rows" % (idx, len(self)))
+        i = np.searchsorted(self.chunk_starts, idx, side = 'right') - 1
+        frames, actions, rewards, dones = self.chunk(i)
+        j = idx - self.chunk_starts[i]
+        return frames[j], actions[j], rewards[j], dones[j]
+
+    def __iter__(self):
+        for frames, actions, rewards, dones in self.iter_chunks():
+            for j in range(len(actions)):
+                yield frames[j], actions[j], rewards[j], dones[j]
+
+    def read(self, start=0, stop=None, frames=True):
+        """Copy rows start to stop into arrays.
+
+        Parameters
+        ----------
+        frames: bool
+          Whether to read the frames, otherwise None is returned for
+          them and only the columns are read.
+
+        Returns
+        -------
+        tuple(np.ndarray)
+          (frames, actions, rewards, dones) of the rows.
+        """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        stop = max(start, stop)
+        num_rows = stop - start
+        out_frames = np.empty((num_rows,) + self.frame_shape, dtype = np.uint8) if frames else None
+        out_actions = np.empty(num_rows, dtype = np.int32)
+        out_rewards = np.empty(num_rows, dtype = np.float64)
+        out_dones = np.empty(num_rows, dtype = np.bool_)
+        first = np.searchsorted(self.chunk_starts, start, side = 'right') - 1
+        for i in range(first, self.num_chunks):
+            chunk_start = self.chunk_starts[i]
+            if chunk_start >= stop:
+                break
+            lo, hi = max(start, chunk_start), min(stop, self.chunk_starts[i + 1])
+            src = slice(lo - chunk_start, hi - chunk_start)
+            dst = slice(lo - start, hi - start)
+            chunk_frames, actions, rewards, dones = self.chunk(i)
+            if frames:
+                out_frames[dst] = chunk_frames[src]
+            out_actions[dst] = actions[src]
+            out_rewards[dst] = rewards[src]
+            out_dones[dst] = dones[src]
+        return out_frames, out_actions, out_rewards, out_dones
+
+    def close(self):
+        self.data = None
+
+
+def is_binary_trace(path):
+    with open(path, 'rb') as f:
+        return f.read(len(TRACE_MAGIC)) == TRACE_MAGIC
+
+
+def iter_trace(path):
+    """Yield the transitions of a trace recorded by the rle wrapper.
+
+    Each item is (state, action, reward, done) with state the full
+    resolution RGB frame seen before taking action. When the trace
+    ends with a state that has no action of its own, it is yielded
+    last with the action of the previous step and a zero reward, the
+    same way the agent stores the last frame of an episode. The last
+    transition is always done, even if the episode was cut short (by
+    max_episode_length or the end of training), so that traces merged
+    back to back into a memory don't share state histories.
+
+    Binary traces (TraceWriter) are read through TraceReader, the
+    frames yielded being views on the memory mapped file. The pickled
+    dicts of older recorders are read too. Those stored the reward
+    instead of the done flag, so only the end of the trace (one trace
+    per episode) is marked done. Their raw frames are released as soon
+    as they are yielded, so only the part of the trace that hasn't been
+    consumed yet stays in memory.
+
+    Parameters
+    ----------
+    path: str
+      Path of a trace.
+    """
+    if is_binary_trace(path):
+        reader = TraceReader(path)
+        last = len(reader) - 1
+        for i, (state, action, reward, done) in enumerate(reader):
+            # a trace that wasn't closed may end anywhere
+            yield state, action, reward, done or i == last
+        return
+    with open(path, 'rb') as tdump:
+        trace = pickle.load(tdump)
+    states = trace.pop('state')
+    actions, rewards = trace['action'], trace['reward']
+    for i in range(len(rewards)):
+        state, states[i] = states[i], None
+        yield state, actions[i], rewards[i], i == len(states) - 2
+    if len(states) > len(rewards):
+        yield states[-1], actions[-1], 0, True
+
+def convert_trace(path, new_size=(84, 84)):
+    """Preprocess a trace into arrays ready for ReplayMemory.extend.
+
+    Meant to run in a worker process, one trace per call. Frames are
+    resized to new_size, (height, width). Binary traces are converted
+    a chunk at a time, straight into the output arrays.
+
+    Returns
+    -------
+    tuple(np.ndarray)
+      (screens, actions, rewards, terminals) of the whole trace.
+    """
+    atari_processor = AtariPreprocessor(new_size)
+    if is_binary_trace(path):
+        return _convert_binary_trace(TraceReader(path), atari_processor)
+    screens, actions, rewards, terminals = [], [], [], []
+    for state, action, reward, done in iter_trace(path):
+        screens.append(atari_processor.process_state_for_memory(state))
+        actions.append(action)
+        rewards.append(atari_processor.process_reward(reward))
+        terminals.append(done)
+    return (np.array(screens, dtype = np.uint8), np.array(actions, dtype = np.int8),
+        np.array(rewards, dtype = np.float64), np.array(terminals, dtype = np.bool_))
+
+
+def _convert_binary_trace(reader, atari_processor):
+    screens = np.empty((len(reader),) + atari_processor.new_size, dtype = np.uint8)
+    actions = np.empty(len(reader), dtype = np.int8)
+    rewards = np.empty(len(reader), dtype = np.float64)
+    terminals = np.empty(len(reader), dtype = np.bool_)
+    for i, (frames, chunk_actions, chunk_rewards, dones) in enumerate(reader.iter_chunks()):
+        rows = slice(reader.chunk_starts[i], reader.chunk_starts[i + 1])
+        atari_processor.process_batch_for_memory(frames, screens[rows])
+        actions[rows] = chunk_actions
+        rewards[rows] = atari_processor.process_reward(chunk_rewards)
+        terminals[rows] = dones
+    # the trace may have been cut short, see iter_trace
+    terminals[-1:] = True
+    return screens, actions, rewards, terminals
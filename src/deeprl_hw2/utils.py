@@ -1,5 +1,9 @@
 """Common functions you may find useful in your implementation."""
 
+import queue
+import threading
+
+import numpy as np
 import semver
 import tensorflow as tf
 
@@ -124,4 +128,111 @@ class RLEEnvPerLifeWrapper(object):
         return next_state, reward, done, info
 
     def lives(self):
-        return self.rle.lives()
\ No newline at end of file
+        return self.rle.lives()
+
+
+class BatchPrefetcher(object):
+    """Builds training batches in a background thread.
+
+    The worker thread keeps calling build_batch and puts the results
+    in a bounded queue, so the next batches are prepared while the
+    caller trains on the current one. With the default depth of two
+    the queue is double buffered.
+
+    build_batch runs concurrently with the caller, anything it shares
+    with the caller (e.g. the replay memory) has to be locked.
+
+    Parameters
+    ----------
+    build_batch: callable
+      Called without arguments, returns one batch.
+    depth: int
+      Number of batches kept ready in the queue.
+    """
+    def __init__(self, build_batch, depth=2):
+        self.build_batch = build_batch
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='BatchPrefetcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        try:
+            while not self.stopped.is_set():
+                self._put(self.build_batch())
+        except BaseException as e:
+            # hand the error over to the caller
+            self._put(e)
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(self):
+        """Return the next batch, waiting for it if it isn't ready."""
+        item = self.queue.get()
+        if isinstance(item, BaseException):
+            self.close()
+            raise item
+        return item
+
+    def close(self):
+        """Stop the worker thread and drop the prepared batches."""
+        self.stopped.set()
+        self.thread.join()
+
+
+class StreamingQuantile(object):
+    """Estimates quantiles of a stream of values in constant memory.
+
+    Values are counted in a fixed histogram over [low, high] and
+    quantiles are interpolated inside the bins, so the error is at
+    most one bin width, (high - low) / num_bins. Values out of the
+    range are counted in the first or last bin.
+
+    Parameters
+    ----------
+    low: float
+      Lowest expected value.
+    high: float
+      Highest expected value.
+    num_bins: int
+      Number of histogram bins.
+    """
+    def __init__(self, low, high, num_bins=10000):
+        self.low = low
+        self.high = high
+        self.num_bins = num_bins
+        self.bin_width = (high - low) / float(num_bins)
+        self.counts = np.zeros(num_bins, dtype=np.int64)
+        self.count = 0
+
+    def add(self, value):
+        """Count one value."""
+        index = int((value - self.low) / self.bin_width)
+        self.counts[min(max(index, 0), self.num_bins - 1)] += 1
+        self.count += 1
+
+    def quantile(self, q):
+        """Return the value below which a fraction q of the values fall.
+
+        Same as the value at index int(q * count) of the sorted values,
+        up to the bin width.
+        """
+        if self.count == 0:
+            raise ValueError("No value to compute a quantile of")
+        rank = min(int(q * self.count), self.count - 1)
+        cumulative = np.cumsum(self.counts)
+        index = int(np.searchsorted(cumulative, rank, side='right'))
+        below = cumulative[index] - self.counts[index]
+        fraction = (rank - below + 0.5) / self.counts[index]
+        return self.low + (index + fraction) * self.bin_width
+
+    def reset(self):
+        self.counts.fill(0)
+        self.count = 0
@@ -0,0 +1,132 @@
+"""Several environments stepped in lockstep in worker processes."""
+
+import multiprocessing
+
+import numpy as np
+
+
+def _worker(remote, parent_remote, env_fn, preprocess):
+    """Run one environment, serving the commands sent by VecEnv."""
+    parent_remote.close()
+    try:
+        env = env_fn()
+        while True:
+            command, data = remote.recv()
+            if command == 'step':
+                state, reward, done, info = env.step(data)
+                remote.send((preprocess(state), reward, done, env.lives()))
+            elif command == 'reset':
+                remote.send(preprocess(env.reset()))
+            elif command == 'num_actions':
+                remote.send(env.action_space.n)
+            elif command == 'close':
+                if hasattr(env, 'close'):
+                    env.close()
+                break
+    except KeyboardInterrupt:
+        pass
+    except BaseException as e:
+        # hand the error over to the main process
+        remote.send(e)
+    finally:
+        remote.close()
+
+
+def _identity(state):
+    return state
+
+
+class VecEnv(object):
+    """Runs num_envs environments in subprocesses, in lockstep.
+
+    All the environments are stepped at once, so the emulators run in
+    parallel and the agent can select all their actions with one
+    forward pass. Each observation goes through preprocess in its
+    worker, e.g. AtariPreprocessor.process_state_for_memory, so the
+    preprocessing is parallel too and only small frames go through the
+    pipes.
+
+    Environments are not reset automatically: the caller resets the
+    ones it is done with, e.g. only when all lives are lost.
+
+    The workers are spawned rather than forked, like the one of
+    AsyncEvaluator, so they don't inherit the threads and the
+    tensorflow session of the learner. env_fns and preprocess have to
+    be picklable, and unpickling them imports their modules in every
+    worker. If those import deeprl_hw2, which is the case of
+    AtariPreprocessor and dqn_atari.make_rle_env, each worker starts
+    its own idle tensorflow session, which slows its start and takes
+    some memory.
+
+    Parameters
+    ----------
+    env_fns: list(callable)
+      One function per environment, called in the worker to create it.
+      Seed the environments there, differently for each worker.
+    preprocess: callable, optional
+      Applied to every observation in the worker.
+    """
+    def __init__(self, env_fns, preprocess=None):
+        self.num_envs = len(env_fns)
+        if preprocess is None:
+            preprocess = _identity
+        context = multiprocessing.get_context('spawn')
+        self.remotes, self.worker_remotes = zip(*[context.Pipe() for _ in env_fns])
+        self.processes = []
+        for remote, worker_remote, env_fn in zip(self.remotes, self.worker_remotes, env_fns):
+            process = context.Process(target=_worker, args=(worker_remote, remote, env_fn, preprocess))
+            process.daemon = True
+            process.start()
+            worker_remote.close()
+            self.processes.append(process)
+        self.closed = False
+        self.remotes[0].send(('num_actions', None))
+        self.num_actions = self._receive(self.remotes[0])
+
+    def _receive(self, remote):
+        item = remote.recv()
+        if isinstance(item, BaseException):
+            self.close()
+            raise item
+        return item
+
+    def reset(self, indexes=None):
+        """Reset the environments of indexes, all of them by default.
+
+        Returns
+        -------
+        np.ndarray
+          The stacked first observations of the reset environments.
+        """
+        if indexes is None:
+            indexes = range(self.num_envs)
+        for i in indexes:
+            self.remotes[i].send(('reset', None))
+        return np.stack([self._receive(self.remotes[i]) for i in indexes])
+
+    def step(self, actions):
+        """Step every environment with its action.
+
+        Returns
+        -------
+        tuple(np.ndarray)
+          (states, rewards, dones, lives) of all the environments.
+        """
+        for remote, action in zip(self.remotes, actions):
+            remote.send(('step', int(action)))
+        results = [self._receive(remote) for remote in self.remotes]
+        states, rewards, dones, lives = zip(*results)
+        return (np.stack(states), np.array(rewards, dtype = np.float64),
+            np.array(dones, dtype = np.bool_), np.array(lives))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for remote in self.remotes:
+            try:
+                remote.send(('close', None))
+            except (BrokenPipeError, EOFError):
+                pass
+        for process in self.processes:
+            process.join()
@@ -47,33 +47,47 @@ def get_output_folder(parent_dir, env_name):
     return parent_dir
 
 
+def make_rle_env(rom_path, args, seed, record=False):
+    """Create an rle environment, meant to run in a VecEnv worker."""
+    import random
+    import numpy as np
+    # every worker gets its own seed
+    random.seed(seed)
+    np.random.seed(seed)
+    env = rle(rom_path, record=record, path=args.output, obs_type=args.obs_type, max_pool=args.max_pool,
+              cache_resets=not args.no_reset_cache, record_queue_size=args.record_queue_size,
+              record_policy=args.record_policy)
+    env.seed(seed)
+    if args.perlife:
+        env = RLEEnvPerLifeWrapper(env)
+    return env
+
+
 def trace2mem(args):
-    from deeprl_hw2.preprocessors import AtariPreprocessor
-    from deeprl_hw2.core import ReplayMemory
+    from deeprl_hw2.core import ReplayMemory, save_memory
+    from deeprl_hw2.traces import convert_trace
+    import multiprocessing
+    from functools import partial
     import glob
-    import pickle
     
     memory = ReplayMemory(args)
-    atari_processor = AtariPreprocessor()
 
     count = 0
 
-    for trace_path in glob.glob("%s/*.dmp" % args.trace_dir):
-        with open(trace_path, 'rb') as tdump:
-            trace = pickle.load(tdump)
-        for state, action, reward, done in zip(trace["state"], trace["action"], trace["reward"], trace["done"]):
-            processed_state = atari_processor.process_state_for_memory(state)
-            processed_reward = atari_processor.process_reward(reward)
-            memory.append(processed_state, action, processed_reward, done)
-            count += 1
-        if len(trace["state"]) > len(trace["reward"]):
-            processed_state = atari_processor.process_state_for_memory(trace["state"][-1])
-            memory.append(processed_state, trace["action"][-1], 0, trace["done"][-1])
-            count += 1
+    # traces are preprocessed in parallel and merged in order
+    # binary traces, and the pickled ones of older recorders
+    trace_paths = sorted(glob.glob("%s/*.trc" % args.trace_dir) + glob.glob("%s/*.dmp" % args.trace_dir))
+    # spawned, the workers must not inherit the tensorflow session
+    pool = multiprocessing.get_context('spawn').Pool(args.num_workers or None)
+    convert = partial(convert_trace, new_size = (args.frame_height, args.frame_width))
+    for screens, actions, rewards, terminals in pool.imap(convert, trace_paths):
+        memory.extend(screens, actions, rewards, terminals)
+        count += len(actions)
+    pool.close()
+    pool.join()
 
-    with open(args.mem_dump, 'wb') as mdump:
-        print(count)
-        pickle.dump(memory, mdump)
+    print(count)
+    save_memory(memory, args.mem_dump)
 
 
 def main():  # noqa: D103
@@ -93,15 +107,28 @@ def main():  # noqa: D103
     parser.add_argument('--frame_width', default=84, type=int, help='Resized frame width')
     parser.add_argument('--frame_height', default=84, type=int, help='Resized frame height')
     parser.add_argument('--replay_memory_size', default=1000000, type=int, help='Number of replay memory the agent uses for training')
+    parser.add_argument('--memmap_memory', default=False, action='store_true', help='Keep the replay memory in memory-mapped files under the output folder')
+    parser.add_argument('--memory_dir', default='', help='Directory of a memory-mapped replay memory, reopened if it exists (implies --memmap_memory)')
+    parser.add_argument('--compress_memory', default=False, action='store_true', help='Store replay memory frames zlib compressed')
+    parser.add_argument('--memory_cache_size', default=4096, type=int, help='Number of decompressed frames cached by a compressed replay memory')
+    parser.add_argument('--prioritized_replay', default=False, action='store_true', help='Use proportional prioritized experience replay')
+    parser.add_argument('--priority_alpha', default=0.6, type=float, help='How much prioritization is used, 0 is uniform sampling')
+    parser.add_argument('--priority_beta', default=0.4, type=float, help='Initial importance-sampling correction exponent')
+    parser.add_argument('--priority_beta_steps', default=2500000, type=int, help='Number of sampled batches over which beta is annealed to 1')
+    parser.add_argument('--prefetch_depth', default=0, type=int, help='Number of minibatches prepared ahead in a background thread, 0 disables prefetching')
     parser.add_argument('--target_update_freq', default=10000, type=int, help='The frequency with which the target network is updated')
     parser.add_argument('--train_freq', default=4, type=int, help='The frequency of actions wrt Q-network update')
     parser.add_argument('--save_freq', default=200000, type=int, help='The frequency with which the network is saved')
+    parser.add_argument('--memory_metrics_freq', default=10000, type=int, help='The frequency with which replay memory metrics are written to tensorboard, 0 disables them')
     parser.add_argument('--eval_freq', default=200000, type=int, help='The frequency with which the policy is evlauted')    
     parser.add_argument('--num_burn_in', default=50000, type=int, help='Number of steps to populate the replay memory before training starts')
     parser.add_argument('--load_network', default=False, action='store_true', help='Load trained mode')
     parser.add_argument('--load_network_path', default='', help='the path to the trained mode file')
+    parser.add_argument('--uint8_input', default=False, action='store_true', help='Feed uint8 frames to the network and normalize them in the graph')
     parser.add_argument('--net_mode', default='dqn', help='choose the mode of net, can be linear, dqn, duel')
     parser.add_argument('--max_episode_length', default = 10000, type=int, help = 'max length of each episode')
+    parser.add_argument('--async_eval', default=False, action='store_true', help='evaluate during training in a separate process instead of pausing training')
+    parser.add_argument('--num_episodes_at_eval', default=20, type=int, help='Number of episodes played by each evaluation during training')
     parser.add_argument('--num_episodes_at_test', default = 10, type=int, help='Number of episodes the agent plays at test')
     parser.add_argument('--ddqn', default=False, dest='ddqn', action='store_true', help='enable ddqn')
     parser.add_argument('--train', default=True, dest='train', action='store_true', help='Train mode')
@@ -110,6 +137,12 @@ def main():  # noqa: D103
     parser.add_argument('--no_target', default=False, action='store_true', help='do not use target fixing')
     parser.add_argument('--no_monitor', default=False, action='store_true', help='do not record video')
     parser.add_argument('-p', '--platform', default='rle', help='rle or atari. rle: rle; atari: gym-atari')
+    parser.add_argument('--num_envs', default=1, type=int, help='number of rle emulators stepped in parallel worker processes during training')
+    parser.add_argument('--obs_type', default='rgb', choices=['rgb', 'grayscale'], help='screens the rle emulator returns, grayscale is a third of the size')
+    parser.add_argument('--record_policy', default='block', choices=['block', 'drop'], help='when the recording thread falls behind, wait for it or drop frames')
+    parser.add_argument('--record_queue_size', default=64, type=int, help='number of frames waiting to be recorded before the record policy applies')
+    parser.add_argument('--no_reset_cache', default=False, action='store_true', help='replay the no-ops of every rle reset instead of restoring cached emulator states')
+    parser.add_argument('--max_pool', default=False, action='store_true', help='max pool the last two skipped rle frames against flickering')
     parser.add_argument('-pl', '--perlife', default=False, action='store_true', help='use per life or not. ')
     parser.add_argument('-mv', '--mv_reward', default=False, action='store_true', help='use movement reward or not')
     parser.add_argument('-c', '--clip_reward', default=False, action='store_true', help='clip reward or not')
@@ -121,21 +154,43 @@ def main():  # noqa: D103
     parser.add_argument('--trace_dir', default='', help='the trace dir for expert')
     parser.add_argument('--trace2mem', default=False, action='store_true', help='convert trace to memory')
     parser.add_argument('--mem_dump', default='', help='the path of memory dump')
+    parser.add_argument('--num_workers', default=0, type=int, help='number of processes converting traces, 0 uses all cores')
+    parser.add_argument('--convert_memory', default=None, help='convert a pickled memory dump to a memory snapshot at --mem_dump')
     args = parser.parse_args()
     args.output = get_output_folder(args.output, args.env)
+    if args.memmap_memory and not args.memory_dir:
+        args.memory_dir = os.path.join(args.output, 'memory')
 
     if args.trace2mem:
         trace2mem(args)
         exit(0)
 
-    if args.platform == 'atari':
+    if args.convert_memory:
+        from deeprl_hw2.core import convert_memory
+        convert_memory(args.convert_memory, args.mem_dump)
+        exit(0)
+
+    if args.num_envs > 1 and args.train:
+        if args.platform != 'rle':
+            raise ValueError("--num_envs > 1 needs the rle platform")
+        from deeprl_hw2.vec_env import VecEnv
+        from deeprl_hw2.preprocessors import AtariPreprocessor
+        from functools import partial
+        rom_path = 'roms/' + args.env
+        env = VecEnv([partial(make_rle_env, rom_path, args, args.seed + i, args.no_monitor and i == 0)
+                      for i in range(args.num_envs)],
+                     AtariPreprocessor((args.frame_height, args.frame_width)).process_state_for_memory)
+    elif args.platform == 'atari':
         env = gym.make(args.env)
     else:
         rom_path = 'roms/' + args.env 
         if args.no_monitor:
-            env = rle(rom_path, record=True, path=args.output)
+            env = rle(rom_path, record=True, path=args.output, obs_type=args.obs_type,
+                      max_pool=args.max_pool, cache_resets=not args.no_reset_cache,
+                      record_queue_size=args.record_queue_size, record_policy=args.record_policy)
         else:
-            env = rle(rom_path)
+            env = rle(rom_path, obs_type=args.obs_type, max_pool=args.max_pool,
+                      cache_resets=not args.no_reset_cache)
     print("Output saved to: ", args.output)
     print("Args used:")
     print(args)
@@ -144,17 +199,36 @@ def main():  # noqa: D103
     # create your DQN agent, create your model, etc.
     # then you can run your fit method.
 
-    num_actions = env.action_space.n
+    num_actions = env.num_actions if args.num_envs > 1 and args.train else env.action_space.n
     print("Game ", args.env, " #actions: ", num_actions)
     dqn = DQNAgent(args, num_actions)
     if args.train:
         print("Training mode.")
-        if args.perlife:
-            env = RLEEnvPerLifeWrapper(env)
-        dqn.fit(env, args.num_samples, args.max_episode_length)
+        evaluator = None
+        if args.async_eval:
+            from deeprl_hw2.dqn import AsyncEvaluator
+            from functools import partial
+            if args.platform == 'atari':
+                eval_env_fn = partial(gym.make, args.env)
+            else:
+                eval_env_fn = partial(make_rle_env, 'roms/' + args.env, args, args.seed + args.num_envs)
+            evaluator = AsyncEvaluator(args, num_actions, eval_env_fn)
+        if args.num_envs > 1:
+            dqn.fit_vectorized(env, args.num_samples, args.max_episode_length, evaluator)
+            env.close()
+        else:
+            if args.perlife:
+                env = RLEEnvPerLifeWrapper(env)
+            dqn.fit(env, args.num_samples, args.max_episode_length, evaluator)
+            if args.platform == 'rle':
+                # flushes the recorded episode
+                env.close()
     else:
         print("Evaluation mode.")
         dqn.evaluate(env, args.num_episodes_at_test, args.max_episode_length, not args.no_monitor)
+        if args.platform == 'rle':
+            # flushes the recorded episode
+            env.close()
 
 if __name__ == '__main__':
     main()
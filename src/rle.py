@@ -1,8 +1,10 @@
 from rle_python_interface.rle_python_interface import RLEInterface
+from deeprl_hw2.traces import TraceWriter
 from random import randrange
 import numpy as np
 import imageio
-import pickle
+import queue
+import threading
 
 class actionSet:
     def __init__(self, rle): 
@@ -12,8 +14,128 @@ class actionSet:
     def sample(self):
         return randrange(len(self.minimal_actions))
     
+class Recorder:
+    """Writes the videos and traces of episodes in a background thread.
+
+    The stepping loop only copies the frame and queues it. The thread
+    encodes the video and writes the trace to disk a chunk at a time
+    (TraceWriter), so memory is bounded by the queue size.
+
+    When the queue is full, policy 'block' waits for the thread
+    (nothing is lost) while 'drop' skips the step: it is missing from
+    the video and a gap is marked in the trace. dropped counts them.
+    Episode starts and ends are never dropped.
+    """
+    def __init__(self, path, queue_size = 64, policy = 'block'):
+        if policy not in ('block', 'drop'):
+            raise ValueError("Unknown recording policy %s" % policy)
+        self.path = path
+        self.policy = policy
+        self.queue = queue.Queue(maxsize = queue_size)
+        self.dropped = 0
+        self.gap = False
+        self.error = None
+        self.thread = threading.Thread(target = self._run, name = 'Recorder')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        writer = trace = None
+        try:
+            while True:
+                item = self.queue.get()
+                if item[0] in ('episode', 'close') and writer is not None:
+                    writer.close()
+                    trace.close()
+                    writer = trace = None
+                if item[0] == 'close':
+                    return
+                if item[0] == 'episode':
+                    _, idx_video, state = item
+                    filename = "%s/video-%05d.mp4" % (self.path, idx_video)
+                    writer = imageio.get_writer(filename, fps=20, codec = "mpeg4")
+                    writer.append_data(state)
+                    trace = TraceWriter("%s/trace-%05d.trc" % (self.path, idx_video), state.shape)
+                    trace.write_state(state)
+                else:
+                    _, gap, action, reward, done, next_state = item
+                    if gap:
+                        trace.write_gap()
+                    writer.append_data(next_state)
+                    trace.write_step(action, reward, done, next_state)
+        except BaseException as e:
+            # raised in the stepping loop by the next _put, or by close
+            self.error = e
+        finally:
+            # the files of the episode an error cut short
+            for f in (writer, trace):
+                if f is not None:
+                    try:
+                        f.close()
+                    except Exception:
+                        pass
+
+    def _put(self, item, block = True):
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                # wake up now and then in case the thread died
+                self.queue.put(item, block, 0.1)
+                return True
+            except queue.Full:
+                if not block:
+                    return False
+
+    def start_episode(self, idx_video, state):
+        # always waits, the episode files must be opened in order
+        self._put(('episode', idx_video, state.copy()))
+        self.gap = False
+
+    def record_step(self, action, reward, done, next_state):
+        # the last step of an episode is never dropped, it marks its end
+        block = self.policy == 'block' or done
+        if self._put(('step', self.gap, action, reward, done, next_state.copy()), block):
+            self.gap = False
+        else:
+            self.dropped += 1
+            self.gap = True
+
+    def close(self):
+        """Finish writing the queued frames and close the files.
+
+        Raises the error the thread stopped on, if any.
+        """
+        try:
+            if self.error is None:
+                self._put(('close',))
+        finally:
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
 class rle:
-    def __init__(self, rom, core = 'snes', skip_mean = 7, record = False, path=""):
+    """RLE emulator with a gym-like interface.
+
+    obs_type is 'rgb' or 'grayscale'. Grayscale screens are captured
+    by the emulator, a third of the RGB size. Either way screens are
+    written into preallocated buffers: the returned observation is
+    only valid until the next step but one, so copy it to keep it.
+
+    With max_pool the observation is the pixel-wise max of the last
+    two frames of the skipped ones, which removes sprite flickering.
+
+    Episodes start after a random number of no-ops, 0 to 29. With
+    cache_resets, and if the emulator can clone its state, the state
+    and screen after each number of no-ops are saved on the first
+    reset, and later resets restore one of them at random instead of
+    replaying the no-ops.
+    """
+    num_noop_max = 30
+
+    def __init__(self, rom, core = 'snes', skip_mean = 7, record = False, path="",
+                 obs_type = 'rgb', max_pool = False, cache_resets = True,
+                 record_queue_size = 64, record_policy = 'block'):
         self.rle = RLEInterface()
         self.rle.loadROM(rom, core)
         self.action_space = actionSet(self.rle)
@@ -22,48 +144,91 @@ class rle:
         self.record = record
         if self.record:
             self.idx_video = 0
+            self.recorder = Recorder(path, record_queue_size, record_policy)
+        if obs_type == 'rgb':
+            self.get_screen = self.rle.getScreenRGB
+        elif obs_type == 'grayscale':
+            self.get_screen = self.rle.getScreenGrayscale
+        else:
+            raise ValueError("Unknown obs_type %s" % obs_type)
+        self.obs_type = obs_type
+        self.max_pool = max_pool
+        screen = self.get_screen()
+        # two outputs so the previous observation survives one step,
+        # plus the frame before last for max pooling
+        self.obs_buffers = [np.empty_like(screen), np.empty_like(screen)]
+        self.idx_obs = 0
+        self.pool_buffer = np.empty_like(screen)
+        # cloneState leaves out the emulator's random generator, which
+        # keeps running across episodes as it does without the cache
+        if hasattr(self.rle, 'cloneState'):
+            self.clone_state = self.rle.cloneState
+            self.restore_state = self.rle.restoreState
+        else:
+            cache_resets = False
+        self.cache_resets = cache_resets
+        self.reset_states = None
 
-    def reset(self):
+    def _next_obs_buffer(self):
+        self.idx_obs = 1 - self.idx_obs
+        return self.obs_buffers[self.idx_obs]
+
+    def _cache_reset_states(self):
+        """Save the state and screen after each number of no-ops."""
+        self.reset_states = []
         self.rle.reset_game()
-        # noop
-        num_noop = randrange(30)
-        for i in range(num_noop):
-            self.rle.act(0)
+        for i in range(self.num_noop_max):
+            if i > 0:
+                self.rle.act(0)
+            # restoring a state doesn't restore the screen, keep it too
+            self.reset_states.append((self.clone_state(), self.get_screen().copy()))
 
-        state = self.rle.getScreenRGB()
+    def reset(self):
+        # noop
+        num_noop = randrange(self.num_noop_max)
+        if self.cache_resets:
+            if self.reset_states is None:
+                self._cache_reset_states()
+            reset_state, screen = self.reset_states[num_noop]
+            self.restore_state(reset_state)
+            state = self._next_obs_buffer()
+            np.copyto(state, screen)
+        else:
+            self.rle.reset_game()
+            for i in range(num_noop):
+                self.rle.act(0)
+            state = self.get_screen(self._next_obs_buffer())
         if self.record:
-            if self.idx_video > 0 and not self.writer.closed:
-                self.writer.close()
-                with open(self.trace_path, 'wb') as tdump:
-                    pickle.dump(self.trace, tdump)
             self.idx_video += 1
-            filename = "%s/video-%05d.mp4" % (self.path, self.idx_video)
-            self.writer = imageio.get_writer(filename, fps=20, codec = "mpeg4")
-            self.writer.append_data(state)
-            self.trace_path = "%s/trace-%05d.dmp" % (self.path, self.idx_video)
-            self.trace = {"state": [], "reward": [], "action": [], "done": []}
-            self.trace["state"].append(state)
+            self.recorder.start_episode(self.idx_video, state)
         return state
 
     def step(self, action_ix):
         action = self.action_space.minimal_actions[action_ix]
         reward = 0
-        for i in range(randrange(self.skip_mean-1, self.skip_mean+2)):
+        num_skip = randrange(self.skip_mean-1, self.skip_mean+2)
+        pooled = False
+        for i in range(num_skip):
             reward += self.rle.act(action)
             done = self.rle.game_over()
             if done:
                 break
-        next_state = self.rle.getScreenRGB()
+            if self.max_pool and i == num_skip - 2:
+                self.get_screen(self.pool_buffer)
+                pooled = True
+        next_state = self.get_screen(self._next_obs_buffer())
+        if pooled:
+            np.maximum(next_state, self.pool_buffer, out=next_state)
         if self.record:
-            self.writer.append_data(next_state)
-            self.trace["state"].append(next_state)
-            self.trace["reward"].append(reward)
-            self.trace["action"].append(action_ix)
-            self.trace["done"].append(reward)
+            self.recorder.record_step(action_ix, reward, done, next_state)
         return next_state, reward, done, ''
     
     def lives(self):
         return  self.rle.lives()
 
+    def close(self):
+        if self.record:
+            self.recorder.close()
+
     def seed(self, s):
         self.rle.setInt('random_seed', s)